@@ -0,0 +1,60 @@
+"""
+Builds many configs concurrently in one process and checks that every
+build produces the same playbook as a sequential build of the same config.
+
+    python benchmarks/concurrent_builds.py [configs] [workers]
+"""
+import contextlib
+import io
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from decibel import Decibel, Runbook
+from decibel.ansible.tasks import apt, command, stat, template
+from decibel.flow import after
+
+
+class Service(Runbook):
+    def run_install(self):
+        apt(name=self.vars.package.value(), state="installed")
+
+    @after("run_install")
+    def run_configure(self):
+        conf = stat(path="/etc/service.conf")
+        with conf.stat.exists():
+            template(src="service.conf.j2", dest="/etc/service.conf")
+        command("service --check").where(conf=conf)
+
+
+class Site(Runbook):
+    def run_services(self):
+        for package in ("consul", "vault", "nomad"):
+            Service(package=package, datacenter=self.vars.datacenter)
+
+
+def build(index):
+    config = Decibel(fetch_base_url="https://example.com")
+    with config as ds:
+        with ds.hosts(become=True):
+            for dc in range(index % 5 + 1):
+                Site(datacenter=f"dc{dc}")
+        return yaml.safe_dump(ds.run())
+
+
+def main(configs=64, workers=8):
+    with contextlib.redirect_stdout(io.StringIO()):
+        expected = [build(i) for i in range(configs)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(workers) as pool:
+            results = list(pool.map(build, range(configs)))
+        elapsed = time.perf_counter() - start
+    mismatches = sum(a != b for a, b in zip(expected, results))
+    print(f"{configs} configs on {workers} threads {elapsed:8.3f}s, {mismatches} mismatches")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(*[int(s) for s in sys.argv[1:]]))
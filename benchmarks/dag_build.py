@@ -0,0 +1,61 @@
+"""
+Times Decibel._build_dag on synthetic graphs of increasing size.
+
+    python benchmarks/dag_build.py [sizes...]
+
+In the random graphs every Runnable runs after Runnables inserted before
+it. The chain graphs run every Runnable after the one inserted next, so
+every edge contradicts the insertion order, as happens when @after names
+a method that sorts later.
+"""
+import random
+import sys
+import time
+
+from decibel import Decibel, Runnable
+
+
+def _make_runnable(i):
+    def method():
+        pass
+    method.__qualname__ = f"bench_{i}"
+    return Runnable(method)
+
+
+def make_instance(size, fanin=3, seed=0):
+    rng = random.Random(seed)
+    ds = Decibel(optimizers={})
+    hctx = ds.hosts()
+    runnables = [_make_runnable(i) for i in range(size)]
+    for i, r in enumerate(runnables):
+        for _ in range(min(i, fanin)):
+            r.run_after.add(runnables[rng.randrange(i)])
+        hctx.runnables[r] = None
+    return ds
+
+
+def make_reverse_chain(size):
+    ds = Decibel(optimizers={})
+    hctx = ds.hosts()
+    runnables = [_make_runnable(i) for i in range(size)]
+    for i, r in enumerate(runnables):
+        if i + 1 < size:
+            r.run_after.add(runnables[i + 1])
+        hctx.runnables[r] = None
+    return ds
+
+
+def main(sizes):
+    for kind, make in (("random", make_instance), ("chain", make_reverse_chain)):
+        for size in sizes:
+            ds = make(size)
+            with ds:
+                start = time.perf_counter()
+                dag = ds._build_dag()
+                elapsed = time.perf_counter() - start
+            edges = sum(len(v) for v in dag.graph.values())
+            print(f"{kind:>6} {size:>7} nodes {edges:>7} edges {elapsed:8.3f}s {elapsed / size * 1e6:7.2f}us/node")
+
+
+if __name__ == "__main__":
+    main([int(s) for s in sys.argv[1:]] or [100, 1000, 10000, 50000])
@@ -0,0 +1,142 @@
+"""
+Builds a file_delivery_mode="fetch" config against a local HTTP stand-in for
+the object store, and checks that every file is downloaded once per play.
+
+    python benchmarks/fetch_once.py [hosts] [files]
+
+The playbook is always checked for one delegated, run_once download per
+file and play, with URLs that the stand-in serves and checksums that
+match what it serves. When
+ansible-playbook is installed it is also run, twice, against hosts that are
+all the local machine: the first run must request each file exactly once
+per play, the second must not request anything.
+"""
+import contextlib
+import hashlib
+import http.server
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.request
+
+import yaml
+
+from decibel.cli import build
+
+ROLE = '''
+from decibel import Runbook
+from decibel.tasks import get_file
+
+class Files(Runbook):
+    def run_files(self):
+{calls}
+'''
+
+CONFIG = '''
+from decibel import Decibel
+from roles.files import Files
+
+config = Decibel(
+    localhost_only=False,
+    file_delivery_mode="fetch",
+    fetch_base_url="{url}",
+)
+with config as ds:
+    with ds.hosts("targets"):
+        Files()
+'''
+
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    requests = {}
+
+    def do_GET(self):
+        CountingHandler.requests[self.path] = CountingHandler.requests.get(self.path, 0) + 1
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def write_tree(root, files, url):
+    os.makedirs(os.path.join(root, "roles", "files"))
+    calls = []
+    for i in range(files):
+        with open(os.path.join(root, "roles", "files", f"file{i}.txt"), "w") as f:
+            f.write(f"content {i}\n" * 1000)
+        calls.append(f'        get_file(src="files/file{i}.txt", dest="{root}/out/{{{{ inventory_hostname }}}}/file{i}.txt")')
+    open(os.path.join(root, "roles", "__init__.py"), "w").close()
+    with open(os.path.join(root, "roles", "files.py"), "w") as f:
+        f.write(ROLE.format(calls="\n".join(calls)))
+    with open(os.path.join(root, "site.py"), "w") as f:
+        f.write(CONFIG.format(url=url))
+
+
+def check_playbook(root, files):
+    with open(os.path.join(root, "site.yaml")) as f:
+        plays = [play for play in yaml.safe_load(f) if play["hosts"] == "targets"]
+    for play in plays:
+        downloads = [task for task in play["tasks"] if "get_url" in task]
+        urls = [task["get_url"]["url"] for task in downloads]
+        assert len(urls) == len(set(urls)) == files, urls
+        assert all(task.get("run_once") and task.get("delegate_to") for task in downloads)
+        for task in downloads:
+            with urllib.request.urlopen(task["get_url"]["url"]) as response:
+                digest = hashlib.sha256(response.read()).hexdigest()
+            assert task["get_url"]["checksum"] == f"sha256:{digest}"
+        for task in play["tasks"]:
+            if "copy" not in task:
+                continue
+            name = os.path.basename(task["copy"]["dest"])
+            with open(os.path.join(root, "roles", "files", name), "rb") as f:
+                assert task["copy"]["checksum"] == hashlib.sha1(f.read()).hexdigest()
+    return len(plays)
+
+
+def run_ansible(root, hosts):
+    inventory = os.path.join(root, "inventory.ini")
+    with open(inventory, "w") as f:
+        f.write("[targets]\n")
+        for i in range(hosts):
+            f.write(f"target{i} ansible_connection=local ansible_python_interpreter={sys.executable}\n")
+    subprocess.run(["ansible-playbook", "-i", inventory, "site.yaml"], cwd=root, check=True, stdout=subprocess.DEVNULL)
+
+
+def main(hosts=20, files=5):
+    root = tempfile.mkdtemp()
+    handler = lambda *args, **kwargs: CountingHandler(*args, directory=root, **kwargs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cwd = os.getcwd()
+    try:
+        write_tree(root, files, f"http://127.0.0.1:{server.server_port}")
+        os.chdir(root)
+        with contextlib.redirect_stdout(io.StringIO()):
+            build("site.py")
+        plays = check_playbook(root, files)
+        print(f"Playbook downloads each of {files} files once in each of {plays} plays")
+
+        if shutil.which("ansible-playbook") is None:
+            print("ansible-playbook is not installed, skipping the run against the stand-in")
+            return
+        CountingHandler.requests.clear()
+        run_ansible(root, hosts)
+        requested = sum(CountingHandler.requests.values())
+        assert requested == files * plays, CountingHandler.requests
+        print(f"First run: {requested} requests for {hosts} hosts")
+        CountingHandler.requests.clear()
+        run_ansible(root, hosts)
+        assert not CountingHandler.requests, CountingHandler.requests
+        print("Second run: no requests")
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main(*[int(s) for s in sys.argv[1:]])
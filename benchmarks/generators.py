@@ -0,0 +1,168 @@
+"""
+Synthetic configs for the benchmark suite.
+
+Every generator takes a scale and returns a fresh Decibel instance with
+its Runbooks already instantiated, the same state a config module like
+test.py leaves behind. Runbook classes are created per call, so building
+the same scenario twice never shares Runnables between the builds.
+"""
+from decibel import Decibel, Runbook
+from decibel.ansible.tasks import apt, command, stat, template
+from decibel.flow import after, before
+
+# Every optimizer that ships with decibel, so that the suite times all of them.
+OPTIMIZERS = {
+    "decibel.optimizers.TransitiveReductionOptimizer": {},
+    "decibel.optimizers.FactGatheringOptimizer": {},
+    "decibel.optimizers.MergeIdenticalHostContextsOptimizer": {},
+    "decibel.optimizers.DeduplicateTasksOptimizer": {},
+    "decibel.optimizers.BatchPackagesOptimizer": {},
+}
+
+
+def _method(module, qualname, body):
+    def method(self):
+        body(self)
+    method.__module__ = module
+    method.__name__ = qualname.rpartition(".")[2]
+    method.__qualname__ = qualname
+    return method
+
+
+def _runbook(module, name, methods):
+    """
+    A Runbook class named name, methods maps method names to
+    (body, [decorators]).
+    """
+    namespace = {"__module__": module, "__qualname__": name}
+    for method_name, (body, decorators) in methods.items():
+        f = _method(module, f"{name}.{method_name}", body)
+        for decorator in decorators:
+            f = decorator(f)
+        namespace[method_name] = f
+    return type(name, (Runbook,), namespace)
+
+
+def _tasks(index):
+    def body(self):
+        apt(name=f"package-{index}", state="present")
+        conf = stat(path=f"/etc/service-{index}.conf")
+        with conf.stat.exists():
+            template(src="service.conf.j2", dest=f"/etc/service-{index}.conf")
+        command(f"service-{index} --check --datacenter {{{{ datacenter }}}}").where(conf=conf)
+    return body
+
+
+def _instance(**settings):
+    return Decibel(optimizers=OPTIMIZERS, fetch_base_url="https://example.com", **settings)
+
+
+def wide(scale):
+    """
+    One Runbook with scale independent Runnables.
+    """
+    methods = {f"run_step_{i:05}": (_tasks(i), []) for i in range(scale)}
+    role = _runbook("bench_wide", "Wide", methods)
+    ds = _instance()
+    with ds:
+        with ds.hosts():
+            role(datacenter="dc1")
+    return ds
+
+
+def nested(scale):
+    """
+    A chain of scale Runbooks, each instantiated from a Runnable of the one before.
+    """
+    roles = [None] * scale
+
+    def nest(i):
+        def body(self):
+            _tasks(i)(self)
+            if i + 1 < scale:
+                roles[i + 1](datacenter="dc1", depth=i + 1)
+        return body
+
+    for i in range(scale):
+        roles[i] = _runbook("bench_nested", f"Level{i:05}", {
+            "run_install": (_tasks(i), []),
+            "run_nest": (nest(i), [after("run_install")]),
+        })
+    ds = _instance()
+    with ds:
+        with ds.hosts():
+            roles[0](datacenter="dc1", depth=0)
+    return ds
+
+
+def chains(scale, fanin=8):
+    """
+    One Runbook with scale Runnables, each ordered after the fanin before it,
+    and before the one two steps ahead.
+    """
+    methods = {}
+    for i in range(scale):
+        decorators = []
+        if i:
+            decorators.append(after(*(f"run_step_{j:05}" for j in range(max(0, i - fanin), i))))
+        if i + 2 < scale:
+            decorators.append(before(f"run_step_{i + 2:05}"))
+        methods[f"run_step_{i:05}"] = (_tasks(i), decorators)
+    role = _runbook("bench_chains", "Chains", methods)
+    ds = _instance()
+    with ds:
+        with ds.hosts():
+            role(datacenter="dc1")
+    return ds
+
+
+def host_contexts(scale):
+    """
+    scale host contexts on different host groups, each running the same small Runbook.
+    """
+    role = _runbook("bench_host_contexts", "Role", {
+        "run_install": (_tasks(0), []),
+        "run_configure": (_tasks(1), [after("run_install")]),
+    })
+    ds = _instance(localhost_only=False)
+    with ds:
+        for i in range(scale):
+            with ds.hosts(f"group{i}", become=True):
+                role(datacenter=f"dc{i % 4}")
+    return ds
+
+
+def env_dc(scale):
+    """
+    The env x dc grid of test.py, with scale environments and scale datacenters
+    instantiating a site Runbook that pulls in three service Runbooks.
+    """
+    service = _runbook("bench_env_dc", "Service", {
+        "run_install": (_tasks(0), []),
+        "run_configure": (_tasks(1), [after("run_install")]),
+    })
+
+    def services(self):
+        for name in ("consul", "vault", "nomad"):
+            service(package=name, datacenter=self.vars.datacenter)
+
+    site = _runbook("bench_env_dc", "Site", {
+        "run_base": (_tasks(2), []),
+        "run_services": (services, [after("run_base")]),
+    })
+    ds = _instance()
+    with ds:
+        with ds.hosts(become=True):
+            for env in range(scale):
+                for dc in range(scale):
+                    site(datacenter=f"dc{dc}", region="eu-north", environment=f"env{env}")
+    return ds
+
+
+SCENARIOS = {
+    "wide": wide,
+    "nested": nested,
+    "chains": chains,
+    "host_contexts": host_contexts,
+    "env_dc": env_dc,
+}
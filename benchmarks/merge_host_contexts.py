@@ -0,0 +1,35 @@
+"""
+Times MergeIdenticalHostContextsOptimizer.optimize_run on many host contexts.
+
+    python benchmarks/merge_host_contexts.py [host contexts] [distinct]
+"""
+import sys
+import time
+
+from decibel import Decibel, Runbook
+from decibel.optimizers import MergeIdenticalHostContextsOptimizer
+
+
+class Role(Runbook):
+    def run_install(self):
+        pass
+
+    def run_configure(self):
+        pass
+
+
+def main(count=10000, distinct=100):
+    with Decibel(optimizers={}) as ds:
+        with ds.hosts():
+            for i in range(count):
+                Role(datacenter=f"dc{i % distinct}", backends=["one", "two"])
+        optimizer = MergeIdenticalHostContextsOptimizer({})
+        start = time.perf_counter()
+        optimizer.optimize_run(ds)
+        elapsed = time.perf_counter() - start
+        remaining = len(Role.run_install.host_contexts)
+    print(f"{count} host contexts -> {remaining} {elapsed:8.3f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(s) for s in sys.argv[1:]])
@@ -0,0 +1,78 @@
+"""
+Compares loading a plan with parsing the playbook of the same build.
+
+    python benchmarks/plan_load.py [scale]
+
+Builds the wide scenario at scale (four tasks per Runnable before the
+optimizers), writes both its plan and the plays it renders to, and times
+load_plan against yaml.load with the fastest loader available. Checks that
+the plays rendered from the loaded plan equal the parsed playbook.
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+from decibel.plan import load_plan, write_plan
+
+from generators import wide
+
+try:
+    Loader = yaml.CSafeLoader
+except AttributeError:
+    Loader = yaml.SafeLoader
+
+
+def render(dag):
+    plays = []
+    for r in dag.topological_sort():
+        if not r.tasks:
+            continue
+        for hctx in r.host_contexts:
+            play = hctx.get_yaml(r)
+            if play["tasks"]:
+                plays.append(play)
+    return plays
+
+
+def _timed(f, *args):
+    start = time.perf_counter()
+    out = f(*args)
+    return out, time.perf_counter() - start
+
+
+def main(scale=10000):
+    root = tempfile.mkdtemp()
+    plan_path = os.path.join(root, "wide.plan.jsonl")
+    yaml_path = os.path.join(root, "wide.yaml")
+    try:
+        ds = wide(scale)
+        with ds, contextlib.redirect_stdout(io.StringIO()):
+            dag = ds._build_dag()
+            with open(plan_path, "w") as f:
+                header = write_plan(dag, f)
+            with open(yaml_path, "w") as f:
+                yaml.dump(render(dag), f, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), sort_keys=False)
+
+        with open(yaml_path) as f:
+            parsed, yaml_time = _timed(yaml.load, f, Loader)
+        loaded, plan_time = _timed(load_plan, plan_path)
+        assert render(loaded) == parsed, "plays rendered from the plan differ from the playbook"
+
+        print(f"{header['tasks']} tasks in {header['runnables']} Runnables")
+        print(f"playbook   {os.path.getsize(yaml_path) / 1e6:7.1f} MB  {yaml_time:7.3f}s  ({Loader.__name__})")
+        print(f"plan       {os.path.getsize(plan_path) / 1e6:7.1f} MB  {plan_time:7.3f}s  "
+              f"({yaml_time / plan_time:.1f}x faster)")
+    finally:
+        for path in (plan_path, yaml_path):
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        os.rmdir(root)
+
+
+if __name__ == "__main__":
+    main(*[int(s) for s in sys.argv[1:]])
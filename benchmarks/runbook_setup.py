@@ -0,0 +1,37 @@
+"""
+Times instantiating a Runbook with many Runnables.
+
+    python benchmarks/runbook_setup.py [methods] [instances]
+"""
+import sys
+import time
+
+from decibel import Decibel, Runbook
+from decibel.flow import after
+
+
+def make_runbook(methods):
+    namespace = {}
+    for i in range(methods):
+        def method(self):
+            pass
+        name = method.__name__ = method.__qualname__ = f"run_step_{i:03}"
+        if i:
+            method = after(f"run_step_{i - 1:03}")(method)
+        namespace[name] = method
+    return type("WideRunbook", (Runbook,), namespace)
+
+
+def main(methods=50, instances=10000):
+    runbook = make_runbook(methods)
+    with Decibel(optimizers={}) as ds:
+        with ds.hosts():
+            start = time.perf_counter()
+            for _ in range(instances):
+                runbook()
+            elapsed = time.perf_counter() - start
+    print(f"{instances} x {methods}-method Runbook {elapsed:8.3f}s {elapsed / instances * 1e6:7.2f}us/instance")
+
+
+if __name__ == "__main__":
+    main(*[int(s) for s in sys.argv[1:]])
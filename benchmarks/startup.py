@@ -0,0 +1,58 @@
+"""
+Checks the import cost of the decibel CLI with python -X importtime.
+
+Fails if importing decibel.cli takes longer than the budget, or if it pulls
+in a module that only some commands need.
+
+    python benchmarks/startup.py [--budget MS] [--runs N]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Imported by the commands that need them, never at startup.
+DEFERRED = ("yaml", "multiprocessing", "concurrent.futures", "inspect", "json", "decibel.optimizers")
+
+
+def import_times():
+    env = dict(os.environ)
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import decibel.cli"],
+        env=env, capture_output=True, text=True, check=True,
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=60.0, help="milliseconds")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    best = None
+    for _ in range(args.runs):
+        times = import_times()
+        if best is None or times["decibel.cli"] < best["decibel.cli"]:
+            best = times
+    total = best["decibel.cli"] / 1000
+    print(f"import decibel.cli {total:.1f}ms (budget {args.budget:.1f}ms)")
+
+    failed = total > args.budget
+    for name in DEFERRED:
+        if name in best:
+            print(f"{name} is imported at startup")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""
+Times every build phase on the synthetic configs in generators.py.
+
+    python benchmarks/suite.py [--scenario NAME] [--repeat N] [--full]
+                               [--save FILE] [--compare FILE] [--threshold 0.5]
+
+For every scenario and scale it times generating the config (which runs
+each Runbook._setup), Decibel._build_dag, Decibel.run, every optimizer's
+optimize_run and optimize_graph, and YAML emission, keeping the fastest of
+--repeat runs. --save writes the results as a JSON baseline, --compare
+reads one and exits with status 1 if any timing got slower than the
+threshold allows. Comparisons account for overall machine speed through a
+calibration workload, but a baseline from the same machine is still the
+most reliable, so regenerate benchmarks/baseline.json before relying on it.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import platform
+import sys
+import time
+
+from decibel.cli import write_plays
+from decibel.profiling import Profiler
+
+from generators import SCENARIOS
+
+SCALES = {
+    "wide": [10, 100, 1000],
+    "nested": [10, 50, 100],
+    "chains": [10, 100, 500],
+    "host_contexts": [10, 100, 1000],
+    "env_dc": [2, 5, 10],
+}
+FULL_SCALES = {
+    "wide": [10, 100, 1000, 5000],
+    "nested": [10, 50, 100, 150],
+    "chains": [10, 100, 500, 2000],
+    "host_contexts": [10, 100, 1000, 5000],
+    "env_dc": [2, 5, 10, 20],
+}
+
+# Differences below this many seconds are noise, whatever the ratio.
+NOISE_FLOOR = 0.002
+
+
+def _calibrate(rounds=5):
+    """
+    Seconds for a fixed pure Python workload, used to tell a slower machine
+    from a slower build.
+    """
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        table = {}
+        for i in range(200000):
+            table[f"key{i % 1000}"] = [i, str(i)]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def measure(generate, scale):
+    times = {}
+    ds, times["config"] = _timed(generate, scale)
+    with ds:
+        _, times["_build_dag"] = _timed(ds._build_dag)
+
+    # _build_dag changes the instance, so run starts over from a fresh config.
+    ds = generate(scale)
+    with Profiler() as profiler:
+        plays, times["run"] = _timed(ds.run)
+    report = profiler.report()
+    for name, phase in report["phases"].items():
+        if name.endswith((".optimize_run", ".optimize_graph")):
+            times[name.rpartition("optimizers.")[2]] = phase["seconds"]
+
+    _, times["yaml"] = _timed(write_plays, plays, io.StringIO())
+    return times, report["counters"]
+
+
+def _measure_quietly(generate, scale):
+    # Like timeit, keep the garbage collector from running in the middle of
+    # a measurement, what it collects depends on what ran before.
+    gc.collect()
+    gc.disable()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return measure(generate, scale)
+    finally:
+        gc.enable()
+
+
+def run_suite(scales, repeat):
+    results = {}
+    for scenario, sizes in scales.items():
+        # Warm up imports and caches, so that the first case is not the slowest.
+        _measure_quietly(SCENARIOS[scenario], min(sizes))
+        for scale in sizes:
+            best = None
+            for _ in range(repeat):
+                times, counters = _measure_quietly(SCENARIOS[scenario], scale)
+                best = times if best is None else {k: min(v, best[k]) for k, v in times.items()}
+            case = f"{scenario}/{scale}"
+            results[case] = {"seconds": best, "counters": counters}
+            print(f"{case:<20} {counters['runnables']:>6} runnables {counters['tasks']:>7} tasks "
+                  f"{counters.get('plays', 0):>6} plays  run {best['run']:8.3f}s  yaml {best['yaml']:8.3f}s")
+    return results
+
+
+def compare(results, calibration, baseline, threshold):
+    """
+    Print every timing that got slower than threshold allows, returns their number.
+    Baseline timings are first scaled by how much slower this machine ran the
+    calibration workload.
+    """
+    speed = calibration / baseline["calibration"]
+    print(f"Calibration ran {speed:.2f}x as long as for the baseline")
+    regressions = 0
+    for case, result in results.items():
+        old = baseline["cases"].get(case)
+        if old is None:
+            continue
+        for name, seconds in result["seconds"].items():
+            before = old["seconds"].get(name)
+            if before is None:
+                continue
+            before *= speed
+            if seconds - before < NOISE_FLOOR:
+                continue
+            if seconds > before * (1 + threshold):
+                regressions += 1
+                print(f"REGRESSION {case} {name}: {before:.4f}s -> {seconds:.4f}s ({seconds / before:.2f}x)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--full", action="store_true", help="also run the largest scales")
+    parser.add_argument("--save", metavar="FILE", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="flag regressions against a baseline")
+    parser.add_argument("--threshold", type=float, default=0.5,
+                        help="allowed slowdown against the baseline, 0.5 is 50%%")
+    args = parser.parse_args(argv)
+
+    scales = FULL_SCALES if args.full else SCALES
+    if args.scenario:
+        scales = {name: sizes for name, sizes in scales.items() if name in args.scenario}
+    calibration = _calibrate()
+    results = run_suite(scales, args.repeat)
+    calibration = min(calibration, _calibrate())
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "calibration": calibration, "cases": results}, f, indent=2, sort_keys=True)
+        print(f"Wrote baseline to {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, calibration, baseline, args.threshold)
+        print(f"{regressions} regressions against {args.compare}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
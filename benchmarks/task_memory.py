@@ -0,0 +1,31 @@
+"""
+Measures memory used per Task.
+
+    python benchmarks/task_memory.py [tasks]
+"""
+import sys
+import tracemalloc
+
+from decibel import Decibel
+from decibel.ansible.tasks import command
+from decibel.flow import run
+
+
+def main(count=100000):
+    @run
+    def many_tasks():
+        for i in range(count):
+            command(f"echo {i}")
+
+    with Decibel(optimizers={}) as ds:
+        with ds.hosts():
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            many_tasks()
+            after = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+    print(f"{count} tasks {(after - before) / count:8.1f} bytes/task")
+
+
+if __name__ == "__main__":
+    main(*[int(s) for s in sys.argv[1:]])
@@ -1,10 +1,11 @@
 import importlib
+import itertools
+import os
 from collections import deque
-import pathlib
 
-from . import context
+from . import context, profiling
 
-from .runnable import Runnable
+from .runnable import Runnable, RunnableState
 from .host_context import HostContext
 from .runbook import Runbook
 
@@ -15,41 +16,87 @@ except ImportError:
 
 DEFAULT_SETTINGS = {
     'merge_runnables': False,
+    'hoist_conditions': False, # move conditions shared by consecutive tasks onto blocks
     'optimizers': {
+        'decibel.optimizers.TransitiveReductionOptimizer': {},
+        'decibel.optimizers.PruneSkippedTasksOptimizer': {},
         'decibel.optimizers.FactGatheringOptimizer': {},
         'decibel.optimizers.MergeIdenticalHostContextsOptimizer': {},
     },
     'localhost_only': True,
-    'file_delivery_mode': 'bundle', # or bundle
+    'fold_predicates': True, # evaluate conditions on Runbook vars at build time
+    'file_delivery_mode': 'bundle', # or repo, fetch
+    'bundle_dir': 'bundle-out', # where file_delivery_mode bundle collects files, next to the playbook
     'fetch_base_url': None,
+    'fetch_cache_host': None, # host that downloads for file_delivery_mode fetch, None for the controller
+    'fetch_cache_dir': None, # where fetched files are kept before they are handed out
+    'schedule': 'serial', # or waves
+    'timings': None, # path to a timing history, see decibel.timings
+    'only': None, # tags or Runnable names to limit the build to
+    'inputs': [], # data files the config reads, so decibel build --skip-unchanged notices when they change
 }
 
 
+def _runnable_key(runnable):
+    return runnable.name
+
+
+# Submodules that are only needed for some builds, and are imported on first use.
+_LAZY_SUBMODULES = ("bundle", "cache", "optimizers", "plan", "plays", "timings")
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 class Decibel():
     def __init__(self, **kwargs):
-        self.base_path = pathlib.Path().resolve()
+        self.base_path = os.path.realpath(os.getcwd())
         self.settings = dict(DEFAULT_SETTINGS, **kwargs)
         self.host_contexts = []
-        self.optimizers = []
-        self._setup_optimizers()
+        self._optimizers = None
+        self._bundle = None
+        # Per build, so that names do not depend on what else the process built.
+        self.variable_ids = itertools.count(1)
+        self._runnable_states = {}
+        self._context_tokens = []
 
     def _import_class(self, fqcn):
         module, _, class_name = fqcn.rpartition(".")
         m = importlib.import_module(module)
         return getattr(m, class_name)
 
-    def _setup_optimizers(self):
-        for opt, settings in self.settings.get("optimizers", {}).items():
-            entry = self._import_class(opt)
-            self.optimizers.append(entry(settings))
+    @property
+    def optimizers(self):
+        # Optimizers are imported when the build first needs them, not when
+        # the config is loaded.
+        if self._optimizers is None:
+            self._optimizers = []
+            for opt, settings in self.settings.get("optimizers", {}).items():
+                entry = self._import_class(opt)
+                self._optimizers.append(entry(settings))
+        return self._optimizers
+
+    @property
+    def bundle(self):
+        if self._bundle is None:
+            from .bundle import Bundle
+            self._bundle = Bundle(self.base_path, self.settings['bundle_dir'])
+        return self._bundle
 
     def __enter__(self):
-        self._old_instance = context.get_current_instance()
-        context.set_current_instance(self)
+        self._context_tokens.append(context.set_current_instance(self))
         return self
 
     def __exit__(self, type, value, tb):
-        context.set_current_instance(self._old_instance)
+        context.reset_current_instance(self._context_tokens.pop())
+
+    def get_runnable_state(self, runnable):
+        state = self._runnable_states.get(runnable)
+        if state is None:
+            state = self._runnable_states[runnable] = RunnableState(runnable)
+        return state
 
     def hosts(self, hosts=None, **kwargs):
         if self.settings['localhost_only']:
@@ -66,37 +113,158 @@ class Decibel():
         # start by applying optimizers on the instance itself
         for opt in self.optimizers:
             print(f"Optimizing run with {opt.name}")
-            opt.optimize_run(self)
+            with profiling.span(f"{opt.name}.optimize_run"):
+                opt.optimize_run(self)
 
         dag = RunnableDAG()
-        for hctx in self.host_contexts:
-            for r in hctx.runnables:
-                dag.add_node(r)
-                for b in r.run_before:
-                    dag.add_edge(r, b) # r must run before b
-                for a in r.run_after:
-                    dag.add_edge(a, r) # a must run before r
+        with profiling.span("build DAG"):
+            # Every edge is known up front, so they are added at once with a
+            # single cycle check rather than one by one.
+            edges = []
+            for hctx in self.host_contexts:
+                for r in hctx.runnables:
+                    dag.add_node(r)
+                    # Sorted, so that the graph is built in the same order on every run.
+                    for b in sorted(r.state.run_before, key=_runnable_key):
+                        dag.add_node(b)
+                        edges.append((r, b)) # r must run before b
+                    for a in sorted(r.state.run_after, key=_runnable_key):
+                        dag.add_node(a)
+                        edges.append((a, r)) # a must run before r
+            dag.add_edges(edges)
         
         # Now apply optimizers on the graph
         for opt in self.optimizers:
             print(f"Optimizing graph with {opt.name}")
-            opt.optimize_graph(dag)
-        
+            with profiling.span(f"{opt.name}.optimize_graph"):
+                opt.optimize_graph(dag)
+
+        if profiling.enabled():
+            profiling.count("host contexts", len(self.host_contexts))
+            profiling.count("runnables", len(dag.graph))
+            profiling.count("edges", sum(len(v) for v in dag.graph.values()))
+            tasks = 0
+            for r in dag.graph:
+                # Tasks of host contexts an optimizer dropped are never emitted.
+                live = {id(hctx) for hctx in r.host_contexts}
+                tasks += sum(1 for t in r.tasks if id(t.host_context) in live)
+            profiling.count("tasks", tasks)
         return dag
 
     def run(self):
-        dag = self._build_dag()
+        return list(self.iter_run())
+
+    def iter_run(self):
+        """
+        Generator version of run, yielding each play as soon as it is built.
+        """
+        with self:
+            dag = self._build_dag()
+            if self.settings['only']:
+                dag = self._select(dag, self.settings['only'])
+            priority = self._critical_path_weights(dag)
+            if self.settings['schedule'] == 'waves':
+                out = self._run_waves(dag, priority)
+            elif self.settings['schedule'] == 'serial':
+                out = self._run_serial(dag, priority)
+            else:
+                raise ValueError("Unknown schedule")
+            if self.settings['merge_runnables']:
+                from . import plays
+                stats = {}
+                out = plays.merge_plays(out, stats)
+            if self.settings['hoist_conditions']:
+                from . import plays
+                hoisted = {}
+                out = plays.hoist_conditions(out, hoisted)
+            for play in out:
+                profiling.count("plays")
+                yield play
+            if self.settings['merge_runnables']:
+                print(f"Merged {stats['before']} plays into {stats['after']}")
+            if self.settings['hoist_conditions'] and hoisted['blocks']:
+                print(f"Hoisted {hoisted['tasks']} task conditions onto {hoisted['blocks']} blocks")
+            if self._bundle is not None:
+                self._bundle.save()
+
+    def _select(self, dag, selectors):
+        """
+        The part of dag needed to run the Runnables matching selectors, that
+        is the matches and everything they depend on. Optimizers that move a
+        task into another Runnable add an edge from that Runnable, so the
+        task is still among what a match depends on.
+        """
+        selectors = set(selectors)
+        selected = [
+            r for r in dag.graph
+            if selectors & ({r.name, r.method.__qualname__} | set(r.task_settings.get("tags", ())))
+        ]
+        if not selected:
+            raise ValueError(f"Nothing matches {', '.join(sorted(selectors))}")
+        sub = dag.subgraph(dag.ancestors(selected))
+        print(f"Selected {len(sub.graph)} of {len(dag.graph)} Runnables")
+        return sub
+
+    def get_costs(self, dag):
+        """
+        Estimated seconds per Runnable from the timing history, or None without one.
+        """
+        if not self.settings['timings']:
+            return None
+        from . import timings
+        return timings.runnable_costs(dag, timings.load_timings(self.settings['timings']))
+
+    def _critical_path_weights(self, dag):
+        costs = self.get_costs(dag)
+        if costs is None:
+            return None
+        weights = dag.longest_paths(costs)
+        roots = dag.independent_nodes()
+        if roots:
+            print(f"Estimated runtime {sum(costs.values()):.1f}s, critical path {max(weights[r] for r in roots):.1f}s")
+        return weights
+
+    def _run_serial(self, dag, priority=None):
         # Topological sort gives us a pretty ordered list that consists of our run order
         # of Runnables.
-        runs = dag.topological_sort()
-        out = []
+        with profiling.span("topological sort"):
+            runs = dag.topological_sort(priority)
         # Dump each Runnable separately.
         for r in runs:
             if not r.tasks:
                 continue
             for hctx in r.host_contexts:
-                out.append(hctx.get_yaml(r))
-        return out
+                play = hctx.get_yaml(r)
+                # Optimizers may have removed every task for this host context.
+                if play["tasks"]:
+                    yield play
+
+    def _run_waves(self, dag, priority=None):
+        # Every wave is an antichain of the DAG, so nothing inside a wave is
+        # ordered and all of it can share one play per host pattern.
+        waves = 0
+        runnables = 0
+        with profiling.span("topological sort"):
+            all_waves = dag.waves(priority)
+        for wave in all_waves:
+            wave = [r for r in wave if r.tasks]
+            if not wave:
+                continue
+            waves += 1
+            runnables += len(wave)
+            wave_plays = OrderedDict()
+            for r in wave:
+                for hctx in r.host_contexts:
+                    block = hctx.get_block_yaml(r)
+                    if not block["block"]:
+                        continue
+                    key = hctx.get_play_key(r)
+                    if key not in wave_plays:
+                        wave_plays[key] = hctx.get_play_yaml(r, f"wave {waves}")
+                    wave_plays[key]["tasks"].append(block)
+            yield from wave_plays.values()
+        if waves:
+            print(f"Scheduled {runnables} Runnables in {waves} waves, parallelism factor {runnables / waves:.2f}")
 
 
 class RunnableDAG():
@@ -106,35 +274,196 @@ class RunnableDAG():
     i.e. from_node must run before to_node.
 
     Implemented from https://github.com/thieman/py-dag.
+
+    The graph keeps a reverse edge map and in-degree counters next to the
+    forward edges, so always mutate it through add_node/add_edge/remove_edge.
     """
     def __init__(self):
         self.graph = OrderedDict()
+        # Incremental topological order (Pearce-Kelly), used to detect cycles
+        # on insert without sorting the whole graph for every edge.
+        self._order = {}
+        self._next_order = 0
+        self._reverse = {}
+        self._in_degree = {}
 
     def add_node(self, node):
         if node not in self.graph:
-            self.graph[node] = set()
+            # Adjacency is kept in ordered dicts rather than sets to keep
+            # iteration order, and thereby the generated playbooks, stable.
+            self.graph[node] = OrderedDict()
+            self._reverse[node] = OrderedDict()
+            self._in_degree[node] = 0
+            self._order[node] = self._next_order
+            self._next_order += 1
 
     def add_edge(self, from_node, to_node):
-        # TODO: test graph on each add
         if from_node not in self.graph:
             self.add_node(from_node)
         if to_node not in self.graph:
             self.add_node(to_node)
-        self.graph[from_node].add(to_node)
+        if to_node in self.graph[from_node]:
+            return
+        if from_node == to_node:
+            raise ValueError(f"Adding {from_node} -> {to_node} causes a cycle")
+        lower, upper = self._order[to_node], self._order[from_node]
+        if lower < upper:
+            # The new edge contradicts the current order, so only the nodes
+            # between the two endpoints have to be searched and reordered.
+            forward = self._search_forward(to_node, from_node, upper)
+            if forward is None:
+                raise ValueError(f"Adding {from_node} -> {to_node} causes a cycle")
+            backward = self._search_backward(from_node, lower)
+            self._reorder(backward, forward)
+        self.graph[from_node][to_node] = None
+        self._reverse[to_node][from_node] = None
+        self._in_degree[to_node] += 1
+
+    def add_edges(self, edges):
+        """
+        Add many (from_node, to_node) edges, checking for cycles once at the
+        end in O(V + E) instead of on every edge. Use it over add_edge when
+        all edges are known up front.
+        """
+        for from_node, to_node in edges:
+            if from_node not in self.graph:
+                self.add_node(from_node)
+            if to_node not in self.graph:
+                self.add_node(to_node)
+            if to_node in self.graph[from_node]:
+                continue
+            if from_node == to_node:
+                raise ValueError(f"Adding {from_node} -> {to_node} causes a cycle")
+            self.graph[from_node][to_node] = None
+            self._reverse[to_node][from_node] = None
+            self._in_degree[to_node] += 1
         try:
-            self.topological_sort()
+            order = self.topological_sort()
         except ValueError:
-            self.graph[from_node].remove(to_node)
-            raise ValueError(f"Adding {from_node} -> {to_node} causes a cycle")
+            in_degree = dict(self._in_degree)
+            queue = [u for u in in_degree if not in_degree[u]]
+            while queue:
+                for v in self.graph[queue.pop()]:
+                    in_degree[v] -= 1
+                    if not in_degree[v]:
+                        queue.append(v)
+            # What is left is every node on a cycle and everything after one.
+            stuck = sorted(repr(u) for u in in_degree if in_degree[u])
+            raise ValueError(f"Dependency cycle among {', '.join(stuck)}") from None
+        self._order = {u: i for i, u in enumerate(order)}
+        self._next_order = len(order)
+
+    def remove_edge(self, from_node, to_node):
+        if to_node not in self.graph.get(from_node, ()):
+            raise KeyError(f"{from_node} -> {to_node} is not in graph")
+        # Removing an edge never invalidates the maintained order.
+        del self.graph[from_node][to_node]
+        del self._reverse[to_node][from_node]
+        self._in_degree[to_node] -= 1
+
+    def _search_forward(self, start, target, upper):
+        """
+        Collect everything reachable from start that is ordered before upper.
+        Returns None if target is reachable, meaning the edge would close a cycle.
+        """
+        seen = {start}
+        stack = [start]
+        while stack:
+            u = stack.pop()
+            for v in self.graph[u]:
+                if v == target:
+                    return None
+                if v not in seen and self._order[v] < upper:
+                    seen.add(v)
+                    stack.append(v)
+        return seen
+
+    def _search_backward(self, start, lower):
+        """
+        Collect everything that reaches start and is ordered after lower.
+        """
+        seen = {start}
+        stack = [start]
+        while stack:
+            u = stack.pop()
+            for v in self._reverse[u]:
+                if v not in seen and self._order[v] > lower:
+                    seen.add(v)
+                    stack.append(v)
+        return seen
+
+    def _reorder(self, backward, forward):
+        order = self._order
+        backward = sorted(backward, key=order.__getitem__)
+        forward = sorted(forward, key=order.__getitem__)
+        slots = sorted(order[n] for n in backward + forward)
+        for node, slot in zip(backward + forward, slots):
+            order[node] = slot
 
     def predecessors(self, node):
-        return [key for key in self.graph if node in self.graph[key]]
+        return list(self._reverse.get(node, ()))
 
     def downstream(self, node):
         if node not in self.graph:
             raise KeyError(f"{node} is not in graph")
         return list(self.graph[node])
 
+    def in_degree(self, node):
+        return self._in_degree[node]
+
+    def out_degree(self, node):
+        return len(self.graph[node])
+
+    def ancestors(self, nodes):
+        """
+        The given nodes and everything that must run before them.
+        """
+        seen = set(nodes)
+        stack = list(nodes)
+        while stack:
+            for v in self._reverse[stack.pop()]:
+                if v not in seen:
+                    seen.add(v)
+                    stack.append(v)
+        return seen
+
+    def subgraph(self, nodes):
+        """
+        New graph with only the given nodes and the edges between them.
+        """
+        sub = RunnableDAG()
+        for u in self.graph:
+            if u in nodes:
+                sub.add_node(u)
+        for u in sub.graph:
+            for v in self.graph[u]:
+                if v in nodes:
+                    sub.add_edge(u, v)
+        return sub
+
+    def transitive_reduction(self):
+        """
+        Remove every edge u -> v where v can also be reached from u through
+        another path. Reachability is kept as one int bitset per node, built
+        in reverse topological order. Returns the number of removed edges.
+        """
+        order = self.topological_sort()
+        index = {u: i for i, u in enumerate(order)}
+        reach = {}
+        removed = 0
+        for u in reversed(order):
+            reachable = 0
+            # Nearest successors first: anything reachable through one of
+            # them is ordered after it.
+            for v in sorted(self.graph[u], key=index.__getitem__):
+                if reachable >> index[v] & 1:
+                    self.remove_edge(u, v)
+                    removed += 1
+                else:
+                    reachable |= reach[v] | 1 << index[v]
+            reach[u] = reachable
+        return removed
+
     def leaves(self):
         return [key for key in self.graph if not self.graph[key]]
 
@@ -142,20 +471,17 @@ class RunnableDAG():
         """
         All nodes that nobody depends on. Our starting points.
         """
-        dependent_nodes = set(
-            node for dependents in self.graph.values() for node in dependents
-        )
-        return [node for node in self.graph.keys() if node not in dependent_nodes]
-
-    def topological_sort(self):
-        in_degree = {}
-        for u in self.graph:
-            in_degree[u] = 0
-
-        for u in self.graph:
-            for v in self.graph[u]:
-                in_degree[v] += 1
+        return [node for node in self.graph if not self._in_degree[node]]
 
+    def topological_sort(self, priority=None):
+        """
+        Nodes in dependency order. With priority, a mapping from node to
+        weight, nodes are still emitted wave by wave, but the heaviest ready
+        node goes first within each wave.
+        """
+        if priority is not None:
+            return [u for wave in self.waves(priority) for u in wave]
+        in_degree = dict(self._in_degree)
         queue = deque()
         for u in in_degree:
             if in_degree[u] == 0:
@@ -173,8 +499,65 @@ class RunnableDAG():
             return out
         raise ValueError("Graph is not acyclic")
 
-    def get_dot(self):
+    def waves(self, priority=None):
+        """
+        Partition the graph into antichains, where each node lands in the wave
+        after its latest dependency. The number of waves is the critical path
+        length of the graph. With priority, each wave is ordered heaviest first.
+        """
+        level = {}
+        out = []
+        for u in self.topological_sort():
+            lvl = level.get(u, 0)
+            if lvl == len(out):
+                out.append([])
+            out[lvl].append(u)
+            for v in self.graph[u]:
+                level[v] = max(level.get(v, 0), lvl + 1)
+        if priority is not None:
+            for wave in out:
+                wave.sort(key=lambda u: -priority.get(u, 0))
+        return out
+
+    def longest_paths(self, costs):
+        """
+        Total cost of the costliest path starting at every node.
+        """
+        weights = {}
+        for u in reversed(self.topological_sort()):
+            weights[u] = costs.get(u, 0) + max((weights[v] for v in self.graph[u]), default=0)
+        return weights
+
+    def critical_path(self, costs):
+        weights = self.longest_paths(costs)
+        path = []
+        candidates = self.independent_nodes()
+        while candidates:
+            u = max(candidates, key=weights.__getitem__)
+            path.append(u)
+            candidates = list(self.graph[u])
+        return path
+
+    def get_dot(self, costs=None):
         print("digraph dag {")
+        path_edges = set()
+        if costs is not None:
+            path = self.critical_path(costs)
+            on_path = set(path)
+            path_edges = set(zip(path, path[1:]))
+            total = sum(costs.get(u, 0) for u in self.graph)
+            critical = sum(costs.get(u, 0) for u in path)
+            print(f"  label=\"estimated runtime {total:.1f}s, critical path {critical:.1f}s\";")
+            for u in self.graph:
+                attrs = f"label=\"{u.name}\\n{costs.get(u, 0):.1f}s\""
+                if u in on_path:
+                    attrs += " color=red"
+                print(f"  \"{u.name}\" [{attrs}];")
         for u in self.graph:
-            print(f"  \"{u.name}\" -> {{\"" + "\" \"".join(v.name for v in self.graph[u]) + "\"};")
+            if costs is None:
+                print(f"  \"{u.name}\" -> {{\"" + "\" \"".join(v.name for v in self.graph[u]) + "\"};")
+                continue
+            for v in self.graph[u]:
+                attrs = " [color=red]" if (u, v) in path_edges else ""
+                print(f"  \"{u.name}\" -> \"{v.name}\"{attrs};")
         print("}")
\ No newline at end of file
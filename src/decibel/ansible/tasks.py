@@ -1,15 +1,20 @@
-import decibel.context as context
-from decibel.dsl import Variable, Predicate
+from types import MappingProxyType
 
-_variable_id = 1
+import decibel.context as context
+from decibel.dsl import Variable, Predicate, fold_conditions
 
 def _generate_variable():
-    global _variable_id
-    name = f"runvar{_variable_id:04}"
-    _variable_id += 1
-    return name
+    return f"runvar{next(context.get_current_instance().variable_ids):04}"
+
+# Shared by every Task until it gets vars or settings of its own.
+_EMPTY = MappingProxyType({})
 
 class Task():
+    # Builds can hold hundreds of thousands of Tasks, so keep them small.
+    # Every slot must be set in __init__, as __getattr__ turns unknown
+    # attributes into task result variables.
+    __slots__ = ("action", "host_context", "variable_name", "runnable", "vars", "args", "kwargs", "settings")
+
     def __init__(self, action):
         r = context.get_current_runnable()
         r.tasks.append(self)
@@ -17,17 +22,21 @@ class Task():
         self.host_context = context.get_current_host_context()
         self.variable_name = _generate_variable()
         self.runnable = r
-        self.vars = {}
-        self.args = []
-        self.kwargs = {}
-        self.settings = {
-            "register": self.variable_name,
-            "tags": [r.method.__qualname__]
-        }
+        self.vars = _EMPTY
+        self.args = ()
+        self.kwargs = _EMPTY
+        # register and tags are derived in get_yaml, settings only holds what
+        # has been set explicitly.
+        self.settings = _EMPTY
         predicates = context.get_current_predicates()
         if predicates:
             self.when(list(predicates))
 
+    def _set(self, key, value):
+        if self.settings is _EMPTY:
+            self.settings = {}
+        self.settings[key] = value
+
     def set_args(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
@@ -38,37 +47,58 @@ class Task():
         return self
 
     def where(self, **kwargs):
+        if self.vars is _EMPTY:
+            self.vars = {}
         for key, runnable in kwargs.items():
             self.vars[key] = f"{{{{ {runnable.variable_name} }}}}"
         return self
 
     def when(self, condition):
-        if isinstance(condition, (list, tuple)):
+        if context.get_current_instance().settings["fold_predicates"]:
+            conditions = fold_conditions(condition if isinstance(condition, (list, tuple)) else [condition])
+            if conditions is False:
+                # Never runs, PruneSkippedTasksOptimizer removes it unless its result is used.
+                condition = False
+            elif not conditions:
+                # Always true, which replaces an earlier when just like
+                # any other condition does.
+                if "when" in self.settings:
+                    self.settings = {k: v for k, v in self.settings.items() if k != "when"}
+                return self
+            elif isinstance(condition, (list, tuple)):
+                condition = conditions
+            else:
+                condition = conditions[0]
+        elif isinstance(condition, (list, tuple)):
             condition = [str(cond) for cond in condition]
         else:
             condition = str(condition)
-        self.settings["when"] = condition
+        self._set("when", condition)
         return self
 
     def run_once(self):
-        self.settings["run_once"] = True
+        self._set("run_once", True)
         return self
 
     def on(self, target):
-        self.settings["delegate_to"] = target
+        self._set("delegate_to", target)
         return self
 
     def on_all(self, target):
-        self.settings["delegate_to"] = "{{ item }}"
-        self.settings["loop"] = target
+        self._set("delegate_to", "{{ item }}")
+        self._set("loop", target)
 
     def get_yaml(self):
         # If regular arg is used, discard any kwargs. If none exist use kwargs instead.
-        task_data = self.args[0] if len(self.args) != 0 else self.kwargs
-        out = dict({}, **self.settings)
+        task_data = self.args[0] if len(self.args) != 0 else dict(self.kwargs)
+        out = {
+            "register": self.variable_name,
+            "tags": [self.runnable.method.__qualname__],
+        }
+        out.update(self.settings)
         out[self.action] = task_data
         if self.vars:
-            out["vars"] = self.vars
+            out["vars"] = dict(self.vars)
         return out
 
     def _escape_formatting(self, val):
@@ -0,0 +1,204 @@
+"""
+Content-addressed file bundle for file_delivery_mode="bundle".
+
+Every file referenced through get_file is hashed and stored once under
+<bundle dir>/objects/<sha256[:2]>/<sha256>, however many Runbooks use it.
+Objects are reflinked where the filesystem supports it, so the bundle takes
+next to no extra space, and copied otherwise. A hard link shares its inode
+with the source file, so editing the source in place would change the
+object too. Objects are therefore only hard linked to sources that nobody
+may write to.
+
+An index of file sizes and modification times lets the next build skip
+hashing files that have not changed. It covers the objects too, and an
+object whose content no longer matches its name is stored again. fetch
+mode uses the same hashing for the checksums of the files it delivers, but
+without a bundle to keep the index in it hashes them on every build.
+
+Objects are never removed, since several configs can share one bundle.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+INDEX_VERSION = 1
+
+# ioctl from linux/fs.h that clones a file on copy-on-write filesystems.
+_FICLONE = 0x40049409
+
+
+def _hash_file(path):
+    """
+    The sha256 of the file, used as its address, and its sha1, which is what
+    the Ansible copy module takes as checksum.
+    """
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            sha256.update(chunk)
+            sha1.update(chunk)
+    return sha256.hexdigest(), sha1.hexdigest()
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+
+
+def _store(src, dst, link):
+    """
+    Put the content of src at dst without copying it if possible, hard
+    linking only if link is set. Returns how.
+    """
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    how = None
+    if sys.platform.startswith("linux"):
+        try:
+            _reflink(src, tmp)
+            how = "reflinked"
+        except OSError:
+            pass
+    if how is None:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        if link:
+            try:
+                os.link(src, tmp)
+                how = "linked"
+            except OSError:
+                pass
+        if how is None:
+            shutil.copyfile(src, tmp)
+            how = "copied"
+    # Rename into place, so that a reader never sees half an object.
+    os.replace(tmp, dst)
+    return how
+
+
+class BundledFile():
+    def __init__(self, path, src, sha256, checksum):
+        self.path = path
+        self.src = src
+        self.sha256 = sha256
+        self.checksum = checksum
+
+
+class Bundle():
+    def __init__(self, base_path, directory):
+        self.base_path = base_path
+        self.directory = directory
+        self.root = os.path.join(base_path, directory)
+        self.index_path = os.path.join(self.root, "index.json")
+        self._index = self._load()
+        self._checksums = {}
+        self._files = {}
+        self.references = 0
+        self.stored = {"reflinked": 0, "linked": 0, "copied": 0}
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != INDEX_VERSION:
+            return {}
+        return data.get("files", {})
+
+    @property
+    def sources(self):
+        """
+        Every file hashed during this build.
+        """
+        return list(self._checksums)
+
+    @property
+    def objects(self):
+        """
+        The sha256 of every object the playbook of this build refers to.
+        """
+        return sorted({bundled.sha256 for bundled in self._files.values()})
+
+    def _object_path(self, sha256):
+        return os.path.realpath(os.path.join(self.root, "objects", sha256[:2], sha256))
+
+    def checksums(self, path):
+        """
+        The sha256 and sha1 of the file at path, hashing it only if it changed
+        since the index saw it last.
+        """
+        path = os.path.realpath(path)
+        entry = self._checksums.get(path)
+        if entry is not None:
+            return entry
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise FileNotFoundError(f"Cannot bundle {path}, it does not exist") from None
+        entry = self._checksums[path] = self._hashes(path, st)
+        return entry
+
+    def _hashes(self, path, st):
+        entry = self._index.get(path)
+        if entry is None or entry[:2] != [st.st_mtime_ns, st.st_size]:
+            entry = [st.st_mtime_ns, st.st_size, *_hash_file(path)]
+            self._index[path] = entry
+        return tuple(entry[2:])
+
+    def is_intact(self, sha256):
+        """
+        Whether the object for sha256 exists and holds the content its name
+        promises.
+        """
+        object_path = self._object_path(sha256)
+        try:
+            st = os.stat(object_path)
+        except OSError:
+            return False
+        return self._hashes(object_path, st)[0] == sha256
+
+    def add(self, path):
+        """
+        Add the file at path to the bundle, and return where a playbook next
+        to the bundle finds it.
+        """
+        self.references += 1
+        path = os.path.realpath(path)
+        bundled = self._files.get(path)
+        if bundled is not None:
+            return bundled
+        sha256, sha1 = self.checksums(path)
+
+        if not self.is_intact(sha256):
+            object_path = self._object_path(sha256)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            read_only = not os.stat(path).st_mode & 0o222
+            self.stored[_store(path, object_path, link=read_only)] += 1
+            if not self.is_intact(sha256):
+                raise RuntimeError(f"{path} changed while it was bundled")
+
+        bundled = self._files[path] = BundledFile(path, f"{self.directory}/objects/{sha256[:2]}/{sha256}", sha256, sha1)
+        return bundled
+
+    def save(self):
+        """
+        Write the index, keeping the entries of earlier builds. Nothing is
+        written unless a file was bundled, so that fetch mode, which only
+        uses the checksums, leaves no bundle directory behind.
+        """
+        if not self._files:
+            return
+        objects = len({bundled.src for bundled in self._files.values()})
+        new = sum(self.stored.values())
+        print(f"Bundled {self.references} references to {len(self._files)} files as {objects} objects, {new} new")
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": INDEX_VERSION, "files": self._index}, f)
+        os.replace(tmp, self.index_path)
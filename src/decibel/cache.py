@@ -0,0 +1,100 @@
+"""
+Build cache for decibel build.
+
+Every build runs the config again, but plays whose content is unchanged
+reuse their serialised YAML.
+
+A config is plain Python and may read data files or environment variables,
+so skipping it entirely is opt-in (decibel build --skip-unchanged). It is
+then skipped when none of the source files it loaded last time, including
+those listed in its inputs setting, have changed.
+"""
+import hashlib
+import json
+import os
+
+import yaml
+
+CACHE_VERSION = 1
+
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BuildCache():
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.path = os.path.join(directory, f"{name}.json")
+        self._data = self._load()
+        self._plays = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        return data
+
+    def is_up_to_date(self, out_file, options=None):
+        """
+        True if the last build used the same options, no source file from it
+        has changed, the output file is still the one that build wrote and
+        every bundle object the output refers to is still intact.
+        """
+        sources = self._data.get("sources")
+        if not sources or self._data.get("options") != (options or {}):
+            return False
+        try:
+            for path, digest in sources.items():
+                if _hash_file(path) != digest:
+                    return False
+            if _hash_file(out_file) != self._data.get("output"):
+                return False
+        except OSError:
+            return False
+        bundle = self._data.get("bundle")
+        if bundle:
+            from .bundle import Bundle
+            objects = Bundle(bundle["base_path"], bundle["directory"])
+            return all(objects.is_intact(sha256) for sha256 in bundle["objects"])
+        return True
+
+    def dump_play(self, play, dumper):
+        key = hashlib.sha256(repr(play).encode()).hexdigest()
+        text = self._data.get("plays", {}).get(key)
+        if text is None:
+            text = yaml.dump([play], Dumper=dumper)
+            self.misses += 1
+        else:
+            self.hits += 1
+        self._plays[key] = text
+        return text
+
+    def save(self, sources, out_file, options=None, bundle=None):
+        data = {
+            "version": CACHE_VERSION,
+            "options": options or {},
+            "sources": {path: _hash_file(path) for path in sorted(set(sources))},
+            "output": _hash_file(out_file),
+            # Only keep plays from this build, so the cache does not grow forever.
+            "plays": self._plays,
+        }
+        if bundle is not None and bundle.objects:
+            data["bundle"] = {
+                "base_path": bundle.base_path,
+                "directory": bundle.directory,
+                "objects": bundle.objects,
+            }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(data, f)
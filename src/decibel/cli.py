@@ -1,8 +1,26 @@
+# The CLI runs from pre-commit hooks and editors, so keep startup cheap:
+# yaml, multiprocessing and friends are imported by the commands that use them.
+import argparse
+import contextlib
+import io
+import itertools
 import sys
 import importlib.util
 import os
-import yaml
-from pathlib import Path
+import time
+import types
+
+
+def _dumper():
+    try:
+        from yaml import CSafeDumper as Dumper
+    except ImportError:
+        from yaml import SafeDumper as Dumper
+    return Dumper
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
 
 
 def _load_config(path):
@@ -10,29 +28,417 @@ def _load_config(path):
     mod = importlib.util.module_from_spec(spec)
     sys.modules["decibel_config"] = mod
     dir_path = os.path.dirname(os.path.realpath(path))
-    sys.path.append(dir_path)
+    if dir_path not in sys.path:
+        sys.path.append(dir_path)
     spec.loader.exec_module(mod)
     return mod
 
 
-def build(path):
+def _module_sources(names):
+    sources = []
+    for name in names:
+        path = getattr(sys.modules.get(name), "__file__", None)
+        if path and os.path.isfile(path):
+            sources.append(os.path.realpath(path))
+    return sources
+
+
+def write_plays(plays, f, cache=None):
+    """
+    Write plays to f one at a time, so that the whole playbook never
+    has to be held in memory as a single string.
+    """
+    import yaml
+    from decibel import profiling
+
+    Dumper = _dumper()
+    empty = True
+    for play in plays:
+        with profiling.span("serialise play"):
+            if cache is not None:
+                f.write(cache.dump_play(play, Dumper))
+            else:
+                yaml.dump([play], f, Dumper=Dumper)
+        empty = False
+    if empty:
+        yaml.dump([], f, Dumper=Dumper)
+
+
+def _replace_if_changed(tmp_file, out_file):
+    with open(tmp_file, "rb") as new:
+        try:
+            with open(out_file, "rb") as old:
+                changed = new.read() != old.read()
+        except OSError:
+            changed = True
+    if changed:
+        os.replace(tmp_file, out_file)
+    else:
+        os.remove(tmp_file)
+    return changed
+
+
+def build(path, cache_dir=None, timings=None, only=None, profile=False, trace=False, loaded=None,
+          skip_unchanged=False):
+    """
+    Build the playbook for the config at path. With profile, a report of where
+    the build spent its time is written next to it as <config>.profile.json,
+    and with trace a Chrome trace of the same as <config>.trace.json.
+    Modules in loaded do not count as sources of the config, see _build.
+    """
+    if not (profile or trace):
+        return _build(path, cache_dir, timings, only, loaded=loaded, skip_unchanged=skip_unchanged)
+
+    from decibel.profiling import Profiler
+
+    with Profiler(path) as profiler:
+        _build(path, cache_dir, timings, only, loaded=loaded, skip_unchanged=skip_unchanged)
+    if profile:
+        profile_file = f"{_stem(path)}.profile.json"
+        profiler.write_report(profile_file)
+        print(f"Wrote build profile to {profile_file}")
+    if trace:
+        trace_file = f"{_stem(path)}.trace.json"
+        profiler.write_trace(trace_file)
+        print(f"Wrote build trace to {trace_file}")
+
+
+def _build(path, cache_dir, timings, only, loaded=None, skip_unchanged=False):
+    """
+    Returns the files the build read, or None if it was skipped as up to date.
+    Modules in loaded, by default everything imported so far, do not count
+    as part of the config.
+
+    The config runs on every build, as it may read files or environment
+    variables the cache knows nothing of. With skip_unchanged, it is skipped
+    when none of the modules it imported and none of the files in its
+    inputs setting changed since the last build.
+    """
+    from decibel import profiling
+    from decibel.cache import BuildCache
+
+    out_file = f"{_stem(path)}.yaml"
+    options = {"timings": timings, "only": only}
+    cache = BuildCache(cache_dir, _stem(path)) if cache_dir else None
+    if skip_unchanged and cache is not None and cache.is_up_to_date(out_file, options):
+        print(f"{out_file} is up to date")
+        return None
+
+    if loaded is None:
+        loaded = set(sys.modules)
+    with profiling.span("import config"):
+        mod = _load_config(path)
+    sources = [os.path.realpath(path)]
+    if timings:
+        mod.config.settings["timings"] = timings
+    if only:
+        mod.config.settings["only"] = only
+    if mod.config.settings["timings"]:
+        sources.append(os.path.realpath(mod.config.settings["timings"]))
+    sources += [os.path.realpath(os.path.join(mod.config.base_path, p)) for p in mod.config.settings["inputs"]]
+    sources += _module_sources(set(sys.modules) - loaded)
+    sources += _module_sources(name for name in sys.modules if name.split(".")[0] == "decibel")
+    with mod.config as ds:
+        tmp_file = f"{out_file}.tmp"
+        with open(tmp_file, "w") as f:
+            write_plays(ds.iter_run(), f, cache)
+        # Bundled files end up in the playbook as checksums.
+        if ds._bundle is not None:
+            sources += ds._bundle.sources
+        if _replace_if_changed(tmp_file, out_file):
+            print(f"Wrote Ansible file to {out_file}")
+        else:
+            print(f"{out_file} is unchanged")
+    if cache is not None:
+        print(f"Reused {cache.hits} of {cache.hits + cache.misses} plays from cache")
+        cache.save(sources, out_file, options, ds._bundle)
+    return sources
+
+# Modules a worker process had before it built any config.
+_worker_modules = None
+
+def _init_worker():
+    # Import decibel once per worker process, every config built there reuses it.
+    global _worker_modules
+    import decibel.cache
+    import decibel.optimizers
+    _worker_modules = set(sys.modules)
+
+
+def _unload_config(path, modules, sys_path):
+    """
+    Forget what loading a config added to the interpreter, so that the next
+    config built in the same process can use the same module names.
+    """
+    config_dir = os.path.dirname(os.path.realpath(path)) + os.sep
+    for name in set(sys.modules) - modules:
+        module_path = getattr(sys.modules[name], "__file__", None) or ""
+        if name == "decibel_config" or os.path.realpath(module_path).startswith(config_dir):
+            del sys.modules[name]
+    sys.path[:] = sys_path
+
+
+def _build_one(path, cache_dir, timings, only, profile, trace, skip_unchanged):
+    modules = set(sys.modules)
+    sys_path = list(sys.path)
+    log = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            # Modules that an earlier config in this worker imported, such as
+            # shared roles, stay loaded and are still sources of this one.
+            build(path, cache_dir, timings, only, profile, trace, loaded=_worker_modules,
+                  skip_unchanged=skip_unchanged)
+    except Exception:
+        import traceback
+        error = traceback.format_exc()
+    finally:
+        _unload_config(path, modules, sys_path)
+    return path, time.perf_counter() - start, log.getvalue(), error
+
+
+def build_many(paths, cache_dir=None, jobs=None, timings=None, only=None, profile=False, trace=False,
+               skip_unchanged=False):
+    """
+    Build several configs on a process pool. Returns the number of failed configs.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    stems = [_stem(path) for path in paths]
+    duplicates = sorted(set(stem for stem in stems if stems.count(stem) > 1))
+    if duplicates:
+        raise ValueError(f"Configs would write the same output file: {', '.join(duplicates)}")
+
+    with ProcessPoolExecutor(jobs, initializer=_init_worker) as pool:
+        results = list(pool.map(
+            _build_one, paths, itertools.repeat(cache_dir), itertools.repeat(timings),
+            itertools.repeat(only), itertools.repeat(profile), itertools.repeat(trace),
+            itertools.repeat(skip_unchanged),
+        ))
+    failed = 0
+    for path, elapsed, log, error in results:
+        sys.stdout.write(log)
+        if error is not None:
+            failed += 1
+            print(f"{path}: failed after {elapsed:.2f}s")
+            print(error)
+        else:
+            print(f"{path}: built in {elapsed:.2f}s")
+    print(f"Built {len(results) - failed} of {len(results)} configs")
+    return failed
+
+
+def _expand_configs(parser, patterns):
+    paths = []
+    for pattern in patterns:
+        if any(c in pattern for c in "*?["):
+            import glob
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern] if os.path.exists(pattern) else []
+        if not matches:
+            parser.error(f"no config matches {pattern}")
+        paths.extend(match for match in matches if match not in paths)
+    return paths
+
+
+def _config_modules(loaded):
+    return [
+        name for name in sys.modules
+        if name not in loaded and name != "decibel_config" and name.split(".")[0] != "decibel"
+    ]
+
+
+def _forget_changed_modules(changed, loaded):
+    """
+    Remove the config modules loaded from the changed files from sys.modules,
+    along with every module that imported something from them, as those hold
+    on to the old objects. Returns how many modules were removed.
+    """
+    modules = {name: sys.modules[name] for name in _config_modules(loaded)}
+    stale = {
+        name for name, mod in modules.items()
+        if os.path.realpath(getattr(mod, "__file__", None) or "") in changed
+    }
+    grew = bool(stale)
+    while grew:
+        grew = False
+        for name, mod in modules.items():
+            if name in stale:
+                continue
+            for value in list(vars(mod).values()):
+                if isinstance(value, types.ModuleType):
+                    # A package refers to its submodules, and picks up the
+                    # new ones when they are imported again.
+                    origin = None if value.__name__.startswith(f"{name}.") else value.__name__
+                else:
+                    origin = getattr(value, "__module__", None)
+                if origin in stale:
+                    stale.add(name)
+                    grew = True
+                    break
+    for name in stale:
+        del sys.modules[name]
+    return len(stale)
+
+
+def _traceback_files(exc):
+    import traceback
+
+    files = [frame.filename for frame in traceback.extract_tb(exc.__traceback__)]
+    if isinstance(exc, SyntaxError) and exc.filename:
+        files.append(exc.filename)
+    return [os.path.realpath(path) for path in files if os.path.isfile(path)]
+
+
+def _mtimes(paths):
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+
+def _wait_for_changes(mtimes, interval):
+    while True:
+        current = _mtimes(mtimes)
+        changed = {path for path in mtimes if current[path] != mtimes[path]}
+        if changed:
+            return changed
+        time.sleep(interval)
+
+
+def watch(path, cache_dir=None, timings=None, only=None, interval=0.3):
+    """
+    Build the config at path, then build it again whenever the config, a
+    module it imports or a file it bundles changes. Modules that did not
+    change stay imported between builds, so a rebuild only runs the config
+    and the changed modules. Files are polled every interval seconds.
+    """
+    out_file = f"{_stem(path)}.yaml"
+    loaded = set(sys.modules)
+    decibel_files = set(_module_sources(name for name in sys.modules if name.split(".")[0] == "decibel"))
+    watched = {os.path.realpath(path)}
+    reloaded = 0
+    while True:
+        mtimes = _mtimes(watched)
+        before = _mtimes([out_file])[out_file]
+        start = time.perf_counter()
+        log = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(log):
+                sources = _build(path, cache_dir, timings, only, loaded=loaded)
+        except Exception as e:
+            import traceback
+            sys.stdout.write(log.getvalue())
+            traceback.print_exc()
+            status = "failed"
+            # The build stopped partway, so watch what it got to import and
+            # wherever it failed, such as a role with a syntax error.
+            sources = _module_sources(_config_modules(loaded)) + _traceback_files(e)
+        else:
+            sys.stdout.write(log.getvalue())
+            status = "unchanged" if _mtimes([out_file])[out_file] == before else f"wrote {out_file}"
+        new = set(sources) - decibel_files - watched
+        watched |= new
+        mtimes.update(_mtimes(new))
+        elapsed = time.perf_counter() - start
+        print(f"{time.strftime('%H:%M:%S')} {path}: {status} in {elapsed * 1000:.0f}ms, reloaded {reloaded} modules", flush=True)
+
+        changed = _wait_for_changes(mtimes, interval)
+        reloaded = _forget_changed_modules(changed, loaded)
+
+
+def plan(path, out_file=None, only=None):
+    """
+    Write the plan of the config at path, see decibel.plan.
+    """
+    from decibel.plan import write_plan
+
+    out_file = out_file or f"{_stem(path)}.plan.jsonl"
     mod = _load_config(path)
+    if only:
+        mod.config.settings["only"] = only
     with mod.config as ds:
-        res = ds.run()
-        out_file = f"{Path(path).stem}.yaml"
-        with open(out_file, "w+") as f:
-            f.write(yaml.dump(res))
-        print(f"Wrote Ansible file to {out_file}")
+        dag = ds._build_dag()
+        if ds.settings["only"]:
+            dag = ds._select(dag, ds.settings["only"])
+        with open(out_file, "w") as f:
+            header = write_plan(dag, f)
+    print(f"Wrote plan of {header['runnables']} Runnables, {header['tasks']} tasks and {header['edges']} edges to {out_file}")
+
 
-def build_graph(path):
+def build_graph(path, timings=None):
     mod = _load_config(path)
+    if timings:
+        mod.config.settings["timings"] = timings
     with mod.config as ds:
         dag = ds._build_dag()
-        dag.get_dot()
+        dag.get_dot(ds.get_costs(dag))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="decibel")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="write the Ansible playbook for a config")
+    build_parser.add_argument("config", nargs="+", help="config files or glob patterns")
+    build_parser.add_argument("-j", "--jobs", type=int, help="worker processes when building several configs")
+    build_parser.add_argument("--cache-dir", default=".decibel-cache")
+    build_parser.add_argument("--no-cache", action="store_true", help="do not reuse plays from earlier builds")
+    build_parser.add_argument("--skip-unchanged", action="store_true",
+                              help="do not run a config when none of its modules and inputs changed since "
+                                   "the last build, list data files it reads in its inputs setting")
+    build_parser.add_argument("--timings", help="task timing history used to order by critical path")
+    build_parser.add_argument("--only", action="append", metavar="TAG|RUNNABLE",
+                              help="only build what the matching Runnables need, can be repeated")
+    build_parser.add_argument("--profile", action="store_true",
+                              help="write where the build spent its time to <config>.profile.json, "
+                                   "combine with --no-cache to profile a build without cached plays")
+    build_parser.add_argument("--trace", action="store_true",
+                              help="write a Chrome trace of the build to <config>.trace.json")
+
+    watch_parser = commands.add_parser("watch", help="build a config again whenever its sources change")
+    watch_parser.add_argument("config")
+    watch_parser.add_argument("--cache-dir", default=".decibel-cache")
+    watch_parser.add_argument("--no-cache", action="store_true", help="do not reuse plays from earlier builds")
+    watch_parser.add_argument("--timings", help="task timing history used to order by critical path")
+    watch_parser.add_argument("--only", action="append", metavar="TAG|RUNNABLE",
+                              help="only build what the matching Runnables need, can be repeated")
+    watch_parser.add_argument("--interval", type=float, default=0.3, help="seconds between checks for changes")
+
+    plan_parser = commands.add_parser("plan", help="write the build plan of a config as JSON lines")
+    plan_parser.add_argument("config")
+    plan_parser.add_argument("-o", "--output", help="plan file, <config>.plan.jsonl by default")
+    plan_parser.add_argument("--only", action="append", metavar="TAG|RUNNABLE",
+                             help="only plan what the matching Runnables need, can be repeated")
+
+    graph_parser = commands.add_parser("graph", help="print the Runnable graph in dot format")
+    graph_parser.add_argument("config")
+    graph_parser.add_argument("--timings", help="task timing history used to annotate the critical path")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        cache_dir = None if args.no_cache else args.cache_dir
+        paths = _expand_configs(parser, args.config)
+        if len(paths) == 1:
+            build(paths[0], cache_dir=cache_dir, timings=args.timings, only=args.only,
+                  profile=args.profile, trace=args.trace, skip_unchanged=args.skip_unchanged)
+        elif build_many(paths, cache_dir=cache_dir, jobs=args.jobs, timings=args.timings, only=args.only,
+                        profile=args.profile, trace=args.trace, skip_unchanged=args.skip_unchanged):
+            sys.exit(1)
+
+    if args.command == "watch":
+        cache_dir = None if args.no_cache else args.cache_dir
+        try:
+            watch(args.config, cache_dir=cache_dir, timings=args.timings, only=args.only, interval=args.interval)
+        except KeyboardInterrupt:
+            pass
 
-def main():
-    if sys.argv[1] == "build":
-        build(sys.argv[2])
+    if args.command == "plan":
+        plan(args.config, out_file=args.output, only=args.only)
 
-    if sys.argv[1] == "graph":
-        build_graph(sys.argv[2])
\ No newline at end of file
+    if args.command == "graph":
+        build_graph(args.config, timings=args.timings)
@@ -1,50 +1,61 @@
-_global_current_instance = None
-_global_current_host_context = None
-_global_current_runbook = None
-_global_current_runnable = None
+from contextvars import ContextVar
 
-_global_current_predicates = set()
+# Build state lives in context variables rather than module globals, so that
+# separate configs can be built concurrently from threads or asyncio tasks.
+# The setters return a token that must be passed to the matching reset.
+_current_instance = ContextVar("decibel_current_instance", default=None)
+_current_host_context = ContextVar("decibel_current_host_context", default=None)
+_current_runbook = ContextVar("decibel_current_runbook", default=None)
+_current_runnable = ContextVar("decibel_current_runnable", default=None)
+
+_current_predicates = ContextVar("decibel_current_predicates", default=())
 
 def get_current_instance():
-    global _global_current_instance
-    return _global_current_instance
+    return _current_instance.get()
 
 def get_current_host_context():
-    global _global_current_host_context
-    return _global_current_host_context
+    return _current_host_context.get()
 
 def get_current_runbook():
-    global _global_current_runbook
-    return _global_current_runbook
+    return _current_runbook.get()
 
 def get_current_runnable():
-    global _global_current_runnable
-    return _global_current_runnable
+    return _current_runnable.get()
 
 def set_current_instance(value):
-    global _global_current_instance
-    _global_current_instance = value
+    return _current_instance.set(value)
 
 def set_current_host_context(value):
-    global _global_current_host_context
-    _global_current_host_context = value
+    return _current_host_context.set(value)
 
 def set_current_runbook(value):
-    global _global_current_runbook
-    _global_current_runbook = value
+    return _current_runbook.set(value)
 
 def set_current_runnable(value):
-    global _global_current_runnable
-    _global_current_runnable = value
+    return _current_runnable.set(value)
+
+def reset_current_instance(token):
+    _current_instance.reset(token)
+
+def reset_current_host_context(token):
+    _current_host_context.reset(token)
+
+def reset_current_runbook(token):
+    _current_runbook.reset(token)
+
+def reset_current_runnable(token):
+    _current_runnable.reset(token)
 
 def register_predicate(value):
-    global _global_current_predicates
-    _global_current_predicates.add(value)
+    predicates = _current_predicates.get()
+    if value not in predicates:
+        _current_predicates.set(predicates + (value,))
 
 def unregister_predicate(value):
-    global _global_current_predicates
-    _global_current_predicates.remove(value)
+    predicates = _current_predicates.get()
+    if value not in predicates:
+        raise KeyError(value)
+    _current_predicates.set(tuple(p for p in predicates if p is not value))
 
 def get_current_predicates():
-    global _global_current_predicates
-    return _global_current_predicates
\ No newline at end of file
+    return _current_predicates.get()
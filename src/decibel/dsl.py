@@ -11,11 +11,106 @@ class DesiredState():
         self.statement.when(" or ".join([is_not(str(pred)) for pred in self.predicates]))
 
 
+def _folding():
+    instance = context.get_current_instance()
+    return instance is not None and instance.settings.get("fold_predicates", False)
+
+
+def fold(expr):
+    """
+    Partially evaluate expr with the values known at build time, which are
+    the vars of the current Runbook. Returns True or False if the outcome is
+    known, and otherwise an equivalent expression without the known parts.
+    """
+    if isinstance(expr, Predicate):
+        return expr.fold()
+    if isinstance(expr, Variable) and expr._known:
+        return bool(expr._actual_value)
+    if isinstance(expr, Constant):
+        return bool(expr.val)
+    return expr
+
+
+def fold_conditions(conditions):
+    """
+    Fold a list of conditions that must all hold, as in a task's when.
+    Returns False if one of them never holds, and otherwise the conditions
+    that are not known to hold, rendered once each.
+    """
+    out = []
+    for condition in conditions:
+        condition = fold(condition)
+        if condition is False:
+            return False
+        if condition is True:
+            continue
+        condition = str(condition)
+        if condition not in out:
+            out.append(condition)
+    return out
+
+
 class Predicate:
     def __init__(self, left, predicate=None, right=None):
         self.left = left
         self.predicate = predicate
         self.right = right
+        self._registered = False
+
+    def _terms(self, predicate):
+        """
+        Operands of a chain of the same boolean operator, such as a | b | c.
+        """
+        for side in (self.left, self.right):
+            if isinstance(side, Predicate) and side.predicate == predicate:
+                yield from side._terms(predicate)
+            else:
+                yield side
+
+    def fold(self):
+        """
+        See fold(). Never calls bool() on a Predicate, that would register it.
+        """
+        if not self.predicate:
+            left = fold(self.left)
+            if isinstance(left, bool):
+                return left
+            return self if left is self.left else Predicate(left)
+
+        if self.predicate in ("and", "or"):
+            absorbing = self.predicate == "or"
+            terms = {}
+            for term in self._terms(self.predicate):
+                term = fold(term)
+                if isinstance(term, bool):
+                    if term is absorbing:
+                        return absorbing
+                    continue
+                # Sub-expressions that render the same are the same.
+                terms.setdefault(str(term), term)
+            if not terms:
+                return not absorbing
+            terms = list(terms.values())
+            out = terms[0]
+            for term in terms[1:]:
+                out = Predicate(out, self.predicate, term)
+            return out
+
+        if self.predicate in ("==", "!=") and isinstance(self.left, Variable) and self.left._known:
+            right = self.right.val if isinstance(self.right, Value) else self.right
+            if isinstance(right, Variable):
+                # Another var is only known if it is a Runbook var, a task
+                # result is only known on the host.
+                if not right._known:
+                    return self
+                right = right._actual_value
+            elif isinstance(right, Predicate):
+                return self
+            equal = self.left._actual_value == right
+            if not isinstance(equal, bool):
+                return self
+            return equal if self.predicate == "==" else not equal
+        return self
 
     def __and__(self, other):
         return Predicate(self, "and", other)
@@ -29,17 +124,32 @@ class Predicate:
         return f"({str(self.left)} {str(self.predicate)} {str(self.right)})"
 
     def __bool__(self):
-        context.register_predicate(self)
+        # Used as `if predicate:`. When the outcome is known at build time the
+        # branch is taken or skipped right away, and nothing is registered.
+        folded = self.fold() if _folding() else self
+        if folded is False:
+            return False
+        if folded is not True:
+            context.register_predicate(self)
+            self._registered = True
         return True
 
     def __neg__(self):
-        context.unregister_predicate(self)
+        if self._registered:
+            self._registered = False
+            context.unregister_predicate(self)
 
     def __enter__(self):
-        context.register_predicate(self)
+        # A with block cannot be skipped, a known false predicate is
+        # registered and left to fold tasks inside it to when: false.
+        if not _folding() or self.fold() is not True:
+            context.register_predicate(self)
+            self._registered = True
 
     def __exit__(self, type, value, tb):
-       context.unregister_predicate(self)
+        if self._registered:
+            self._registered = False
+            context.unregister_predicate(self)
         
 
 ACCESSOR = "."
@@ -53,16 +163,31 @@ class Value:
             return f"'{self.val}'"
         return str(self.val)
 
+class Constant(Value):
+    """
+    A value that is the same on every host, such as default(False).
+    """
+    def __str__(self):
+        return f"d({super().__str__()})"
+
+_UNKNOWN = object()
+
 class Variable:
-    def __init__(self, name, actual_value=None):
+    def __init__(self, name, actual_value=_UNKNOWN):
         self._name = name
-        self._actual_value = actual_value._actual_value if isinstance(actual_value, Variable) else actual_value
+        if isinstance(actual_value, Variable):
+            self._known = actual_value._known
+            self._actual_value = actual_value._actual_value
+        else:
+            # Only Runbook vars have a value at build time, task results do not.
+            self._known = actual_value is not _UNKNOWN
+            self._actual_value = actual_value if self._known else None
     
     def __eq__(self, other):
-        return Predicate(str(self), "==", Value(other))
+        return Predicate(self, "==", Value(other))
 
     def __ne__(self, other):
-        return Predicate(str(self), "!=", Value(other))
+        return Predicate(self, "!=", Value(other))
 
     def __add__(self, other):
         if not isinstance(other, str):
@@ -104,4 +229,4 @@ def is_not(predicate):
     return f"not ({predicate})"
 
 def default(val):
-    return Predicate(f"d({str(Value(val))})")
+    return Predicate(Constant(val))
@@ -1,10 +1,4 @@
-import inspect
-import importlib
-from collections import deque
-import pathlib
-
 from . import context
-from .runnable import Runnable
 
 try:
     from collections import OrderedDict
@@ -18,37 +12,65 @@ class HostContext():
         self.vars = {}
         self.hosts = hosts
         self.settings = kwargs
-        self.runnables = set()
-        self._old_context = None
+        # Insertion ordered, so that builds are reproducible.
+        self.runnables = OrderedDict()
+        self._context_tokens = []
 
     def __repr__(self):
         return f"<HostContext '{self.hosts}' {self.settings}>"
     
     def __enter__(self):
-        self._old_context = context.get_current_host_context()
-        context.set_current_host_context(self)
+        self._context_tokens.append(context.set_current_host_context(self))
         return self
 
     def __exit__(self, type, value, tb):
-        context.set_current_host_context(self._old_context)
+        context.reset_current_host_context(self._context_tokens.pop())
 
     def copy(self):
         return context.get_current_instance().hosts(self.hosts, **self.settings)
 
-    def get_yaml(self, runnable):
-        out = dict({
-            "hosts": self.hosts,
-        }, **self.settings)
+    def _get_tasks_yaml(self, runnable):
         tasks = []
-        settings = {}
         for t in [t for t in runnable.tasks if t.host_context == self]:
             tyaml = t.get_yaml()
             tyaml["name"] = f"{str(t)}"
             tyaml = dict(runnable.task_settings, **tyaml)
             tasks.append(tyaml)
+        return tasks
+
+    def get_play_key(self, runnable):
+        """
+        Plays for Runnables with equal keys can be combined into one play.
+        """
+        settings = dict(self.settings, **runnable.hctx_settings)
+        return (self.hosts, repr(sorted(settings.items())))
+
+    def get_play_yaml(self, runnable, name):
+        """
+        Empty play for this host context, to be filled with blocks from get_block_yaml.
+        """
+        out = dict({
+            "hosts": self.hosts,
+        }, **self.settings)
+        out["tasks"] = []
+        out["name"] = name
+        return dict(runnable.hctx_settings, **out)
+
+    def get_block_yaml(self, runnable):
+        return {
+            "name": runnable.name,
+            "block": self._get_tasks_yaml(runnable),
+            "vars": self.vars,
+        }
+
+    def get_yaml(self, runnable):
+        out = dict({
+            "hosts": self.hosts,
+        }, **self.settings)
+        settings = {}
         settings = dict(settings, **runnable.hctx_settings)
         out["vars"] = self.vars
-        out["tasks"] = tasks
+        out["tasks"] = self._get_tasks_yaml(runnable)
         out["name"] = runnable.name
         out = dict(settings, **out)
-        return out
\ No newline at end of file
+        return out
@@ -1,6 +1,7 @@
+import re
+
 from decibel.ansible.tasks import setup
 from decibel.flow import run
-from decibel.host_context import HostContext
 class Optimizer:
     def __init__(self, settings):
         self.settings = settings
@@ -14,6 +15,17 @@ class Optimizer:
     def name(self):
         return f"{self.__module__}.{self.__class__.__name__}"
 
+class TransitiveReductionOptimizer(Optimizer):
+    """
+    Drops dependency edges that are implied by other edges, such as those
+    every Runnable inherits from its Runbook. Keep it first, so that the
+    optimizers after it work on the smaller graph.
+    """
+    def optimize_graph(self, graph):
+        removed = graph.transitive_reduction()
+        if removed:
+            print(f"Removed {removed} redundant edges")
+
 class FactGatheringOptimizer(Optimizer):
     @run
     def gather_facts_once(self):
@@ -27,31 +39,311 @@ class FactGatheringOptimizer(Optimizer):
             hctx.settings["gather_facts"] = False
 
     def optimize_graph(self, graph):
-        # Find the currently first node in the graph
-        # Set ourselves to run before that
-        first = graph.topological_sort()[0]
+        # Run before every current starting point, so facts are gathered
+        # first even when only part of the graph is built.
+        roots = [r for r in graph.independent_nodes() if r != self.gather_facts_once]
         graph.add_node(self.gather_facts_once)
-        graph.add_edge(self.gather_facts_once, first)
+        for root in roots:
+            graph.add_edge(self.gather_facts_once, root)
 
-def hctx_eq(first, other):
-    return first.instance == other.instance and first.hosts == other.hosts and first.settings == other.settings and first.vars == other.vars and first.runnables == other.runnables
+def _freeze(value):
+    """
+    Canonical hashable form of a (nested) value. Types are kept, so that
+    1, 1.0 and True, which render differently in YAML, stay different.
+    """
+    if isinstance(value, dict):
+        items = ((_freeze(k), _freeze(v)) for k, v in value.items())
+        return (dict, tuple(sorted(items, key=repr)))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(v) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(_freeze(v) for v in value))
+    try:
+        hash(value)
+    except TypeError:
+        # Nothing to compare it by, so it only equals itself.
+        return (type(value), id(value))
+    return (type(value), value)
 
-def hctx_hash(self):
-    return hash((self.instance, self.hosts, frozenset(self.settings.items()), frozenset(self.vars.items()), frozenset(self.runnables)))
+def hctx_fingerprint(hctx):
+    return (hctx.hosts, _freeze(hctx.settings), _freeze(hctx.vars), frozenset(hctx.runnables))
 
 class MergeIdenticalHostContextsOptimizer(Optimizer):
     def optimize_run(self, instance):
-        old_eq = HostContext.__eq__
-        old_hash = HostContext.__hash__
-        HostContext.__eq__ = hctx_eq
-        HostContext.__hash__ = hctx_hash
-        for hctx in instance.host_contexts:
-            for r in hctx.runnables:
-                orig_len = len(r.host_contexts)
-                r.host_contexts = list(set(r.host_contexts))
-                new_len = len(r.host_contexts)
-                if orig_len != new_len:
-                    print(f"Optimized host contexts for f{r}, reduced by {orig_len - new_len}")
-        HostContext.__eq__ = old_eq
-        HostContext.__hash__ = old_hash
+        # Fingerprint every host context once, then dedup each Runnable's
+        # host contexts by fingerprint, keeping the first of each.
+        fingerprints = {id(hctx): hctx_fingerprint(hctx) for hctx in instance.host_contexts}
+        runnables = dict.fromkeys(r for hctx in instance.host_contexts for r in hctx.runnables)
+        removed = 0
+        for r in runnables:
+            unique = {}
+            for hctx in r.host_contexts:
+                key = fingerprints.get(id(hctx))
+                if key is None:
+                    key = fingerprints[id(hctx)] = hctx_fingerprint(hctx)
+                unique.setdefault(key, hctx)
+            if len(unique) != len(r.host_contexts):
+                removed += len(r.host_contexts) - len(unique)
+                r.host_contexts = list(unique.values())
+        if removed:
+            print(f"Removed {removed} duplicate host contexts from Runnables")
+
+_RUNVAR = re.compile(r"\brunvar\d+\b")
+_IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+
+def _strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield from _strings(k)
+            yield from _strings(v)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            yield from _strings(v)
+
+def _tasks_by_host_context(runnable):
+    """
+    The tasks of runnable grouped by the id of their host context, in order.
+    """
+    tasks = {}
+    for t in runnable.tasks:
+        tasks.setdefault(id(t.host_context), []).append(t)
+    return tasks
+
+def _referenced_variables(graph, skip=()):
+    """
+    Names of all registered task variables that some task refers to.
+    """
+    used = set()
+    for r in graph.graph:
+        for t in r.tasks:
+            if id(t) in skip:
+                continue
+            content = t.get_yaml()
+            del content["register"]
+            used.update(name for s in _strings(content) for name in _RUNVAR.findall(s))
+    return used
+
+class PruneSkippedTasksOptimizer(Optimizer):
+    """
+    Removes tasks whose when was folded to false at build time, see
+    decibel.dsl.fold. Ansible still registers the result of a skipped task,
+    so a task whose result another task refers to is kept.
+    """
+    def optimize_graph(self, graph):
+        skipped = {id(t) for r in graph.graph for t in r.tasks if t.settings.get("when") is False}
+        if not skipped:
+            return
+        used = _referenced_variables(graph, skipped)
+        removed = 0
+        for r in graph.graph:
+            tasks = [t for t in r.tasks if id(t) not in skipped or t.variable_name in used]
+            removed += len(r.tasks) - len(tasks)
+            r.state.tasks = tasks
+        if removed:
+            print(f"Removed {removed} tasks that can never run")
+
+# Modules that template files or tasks with the vars of the play, so their
+# outcome can depend on vars that the task itself never mentions.
+TEMPLATE_MODULES = (
+    "template", "ansible.builtin.template",
+    "win_template", "ansible.windows.win_template",
+    "include_tasks", "ansible.builtin.include_tasks",
+    "import_tasks", "ansible.builtin.import_tasks",
+    "include_role", "ansible.builtin.include_role",
+    "import_role", "ansible.builtin.import_role",
+)
+
+# Lookups are how a task reads a template file from a string.
+_FILE_LOOKUPS = frozenset(("lookup", "query", "q"))
+
+class DeduplicateTasksOptimizer(Optimizer):
+    """
+    Removes tasks that repeat an earlier task for the same hosts, such as the
+    tasks of a Runbook instantiated once per environment. Tasks count as equal
+    when their content, and the values of any host context vars they mention,
+    are equal. The Runnable of the kept task is ordered before the Runnable
+    a duplicate was removed from. This assumes tasks are idempotent, so it is
+    not enabled by default.
+
+    A duplicate whose result another task refers to is kept. A repeated
+    idempotent task reports changed and failed differently from the first
+    one, so its result cannot stand in for the first one's.
+
+    With the "loops" setting (on by default), adjacent tasks that differ in a
+    single argument and whose results are never used are folded into one task
+    with a loop.
+
+    Modules that render a file or pull in other tasks, such as template, can
+    read any var of the host context, so for those all vars count. The
+    "template_modules" setting overrides which modules these are.
+    """
+    def optimize_graph(self, graph):
+        self._template_modules = self.settings.get("template_modules", TEMPLATE_MODULES)
+        used = _referenced_variables(graph)
+        seen = {}
+        removed = set()
+        sequences = []
+        for r in graph.topological_sort():
+            by_hctx = _tasks_by_host_context(r)
+            for hctx in r.host_contexts:
+                tasks = []
+                play = (hctx.hosts, _freeze(hctx.settings), _freeze(r.hctx_settings), _freeze(r.task_settings))
+                for t in by_hctx.get(id(hctx), ()):
+                    if id(t) in removed:
+                        continue
+                    key = self._task_key(t, hctx, play)
+                    kept = seen.setdefault(key, t)
+                    if kept is t or t.variable_name in used:
+                        tasks.append(t)
+                    else:
+                        removed.add(id(t))
+                        if kept.runnable != r:
+                            graph.add_edge(kept.runnable, r)
+                sequences.append(tasks)
+
+        folded = 0
+        if self.settings.get("loops", True):
+            folded = self._fold_loops(graph, sequences, removed)
+
+        for r in graph.graph:
+            r.state.tasks = [t for t in r.tasks if id(t) not in removed]
+        if removed:
+            print(f"Removed {len(removed) - folded} duplicate tasks, folded {folded} tasks into loops")
+
+    def _task_key(self, task, hctx, play):
+        content = task.get_yaml()
+        del content["register"]
+        names = set(n for s in _strings(content) for n in _IDENTIFIER.findall(s))
+        if task.action in self._template_modules or names & _FILE_LOOKUPS:
+            used_vars = hctx.vars
+        else:
+            used_vars = {name: val for name, val in hctx.vars.items() if name in names}
+        return (play, _freeze(content), _freeze(used_vars))
+
+    def _fold_loops(self, graph, sequences, removed):
+        used = _referenced_variables(graph, removed)
+        folded = 0
+        for tasks in sequences:
+            i = 0
+            while i < len(tasks):
+                first = tasks[i]
+                group = [first]
+                key = None
+                for t in tasks[i + 1:]:
+                    differing = self._loop_key(first, t, used)
+                    if differing is None or (key is not None and differing != key):
+                        break
+                    key = differing
+                    group.append(t)
+                if len(group) > 1:
+                    values = [t.kwargs[key] for t in group]
+                    first.kwargs = dict(first.kwargs, **{key: "{{ item }}"})
+                    first.with_settings(loop=values)
+                    for t in group[1:]:
+                        removed.add(id(t))
+                    folded += len(group) - 1
+                i += len(group)
+        return folded
+
+    def _loop_key(self, first, other, used):
+        """
+        Name of the only argument that differs between two tasks that can
+        share a loop, or None if they cannot.
+        """
+        if first.args or other.args or first.vars or other.vars:
+            return None
+        if first.variable_name in used or other.variable_name in used:
+            return None
+        if first.action != other.action or first.settings != other.settings or "loop" in first.settings:
+            return None
+        if first.kwargs.keys() != other.kwargs.keys():
+            return None
+        differing = [k for k in first.kwargs if first.kwargs[k] != other.kwargs[k]]
+        if len(differing) != 1:
+            return None
+        values = (first.kwargs[differing[0]], other.kwargs[differing[0]])
+        if not all(isinstance(v, (str, int, float)) for v in values):
+            return None
+        return differing[0]
+
+PACKAGE_MODULES = (
+    "apt", "ansible.builtin.apt",
+    "package", "ansible.builtin.package",
+    "dnf", "ansible.builtin.dnf",
+    "yum", "ansible.builtin.yum",
+)
+
+def _is_template_free(value):
+    return not any("{{" in s or "{%" in s for s in _strings(value))
+
+class BatchPackagesOptimizer(Optimizer):
+    """
+    Folds package installs from unordered Runnables into one package manager
+    call with a list of names, so N packages cost one transaction.
+
+    Only Runnables in the same wave of the graph are batched. They are
+    unordered with each other and everything they depend on has already run,
+    so each install can move up to the first one. That one then has to run
+    first, whatever order the wave is emitted in, so its Runnable is ordered
+    before those it took installs from. An install only moves if it
+    is the first task of its Runnable on those hosts, has no when, loop or
+    other settings, uses no templating and its result is never referred to.
+    The "modules" setting overrides which modules count as package managers.
+    """
+    def optimize_graph(self, graph):
+        modules = self.settings.get("modules", PACKAGE_MODULES)
+        used = _referenced_variables(graph)
+        groups = {}
+        for level, wave in enumerate(graph.waves()):
+            for r in wave:
+                by_hctx = _tasks_by_host_context(r)
+                for hctx in r.host_contexts:
+                    for i, t in enumerate(by_hctx.get(id(hctx), ())):
+                        if not self._is_batchable(t, modules, used):
+                            continue
+                        options = {k: v for k, v in t.kwargs.items() if k != "name"}
+                        key = (level, hctx.hosts, _freeze(hctx.settings), _freeze(r.hctx_settings), t.action, _freeze(options))
+                        group = groups.setdefault(key, [])
+                        # The first install of a group stays where it is, the
+                        # others move up to it.
+                        if group and i != 0:
+                            continue
+                        group.append(t)
+
+        batched = set()
+        for group in groups.values():
+            if len(group) < 2:
+                continue
+            first = group[0]
+            names = []
+            tags = []
+            for t in group:
+                for name in (t.kwargs["name"] if isinstance(t.kwargs["name"], list) else [t.kwargs["name"]]):
+                    if name not in names:
+                        names.append(name)
+                tag = t.runnable.method.__qualname__
+                if tag not in tags:
+                    tags.append(tag)
+            first.kwargs = dict(first.kwargs, name=names)
+            first.with_settings(tags=tags)
+            batched.update(id(t) for t in group[1:])
+            for t in group[1:]:
+                if t.runnable != first.runnable:
+                    graph.add_edge(first.runnable, t.runnable)
+
+        for r in graph.graph:
+            r.state.tasks = [t for t in r.tasks if id(t) not in batched]
+        if batched:
+            print(f"Batched {len(batched)} package installs into earlier transactions")
 
+    def _is_batchable(self, task, modules, used):
+        if task.action not in modules or task.args or task.vars or task.settings:
+            return False
+        if task.variable_name in used or "name" not in task.kwargs:
+            return False
+        name = task.kwargs["name"]
+        if not isinstance(name, (str, list)):
+            return False
+        return _is_template_free(task.kwargs)
@@ -0,0 +1,190 @@
+"""
+Compact plan format, written by decibel plan.
+
+A plan is what a build decided before it is turned into YAML: the
+Runnables, their host contexts and tasks, and the edges of the graph after
+the optimizers ran. It is stored as JSON lines:
+
+    {"format": "decibel-plan", "version": 1, ...counts}
+    {"strings": [...]}
+    ["h", hosts, settings, vars]                        host context
+    ["r", name, task settings, hctx settings, [hctx]]  Runnable
+    ["t", runnable, hctx, task]                        task, as get_yaml renders it
+    ["e", from, to]                                     edge, from runs first
+
+Host contexts, Runnables and tasks are numbered in the order they appear.
+Every string is stored once in the string table and referred to by index.
+Other values are encoded as true, false and null for themselves,
+{"n": number}, {"l": [items]} and {"d": [key, value, ...]}.
+
+load_plan reads a plan back into a RunnableDAG without running the config.
+"""
+import json
+from collections.abc import Mapping
+
+from . import RunnableDAG
+from .host_context import HostContext
+
+PLAN_FORMAT = "decibel-plan"
+PLAN_VERSION = 1
+
+
+class _Encoder():
+    def __init__(self):
+        self.strings = []
+        self._ids = {}
+
+    def __call__(self, value):
+        if isinstance(value, str):
+            i = self._ids.get(value)
+            if i is None:
+                i = self._ids[value] = len(self.strings)
+                self.strings.append(value)
+            return i
+        if value is None or isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            return {"n": value}
+        if isinstance(value, (list, tuple)):
+            return {"l": [self(v) for v in value]}
+        if isinstance(value, Mapping):
+            return {"d": [x for k, v in value.items() for x in (self(k), self(v))]}
+        raise TypeError(f"Cannot write {type(value).__name__} to a plan")
+
+
+def _decoder(strings):
+    def decode(value):
+        if type(value) is int:
+            return strings[value]
+        if value is None or isinstance(value, bool):
+            return value
+        if "n" in value:
+            return value["n"]
+        if "l" in value:
+            return [decode(v) for v in value["l"]]
+        items = value["d"]
+        return {decode(items[i]): decode(items[i + 1]) for i in range(0, len(items), 2)}
+    return decode
+
+
+def write_plan(dag, f):
+    """
+    Write the plan of a built graph to f. Must run inside the Decibel
+    instance that built it, as that holds the state of the Runnables.
+    """
+    enc = _Encoder()
+    hctx_ids = {}
+    hctx_records = []
+    records = []
+    index = {}
+    tasks = 0
+    for r in dag.graph:
+        index[r] = len(index)
+        hctxs = []
+        live = {id(hctx) for hctx in r.host_contexts}
+        for hctx in r.host_contexts:
+            if id(hctx) not in hctx_ids:
+                hctx_ids[id(hctx)] = len(hctx_records)
+                hctx_records.append(["h", enc(hctx.hosts), enc(hctx.settings), enc(hctx.vars)])
+            hctxs.append(hctx_ids[id(hctx)])
+        records.append(["r", enc(r.name), enc(r.task_settings), enc(r.hctx_settings), hctxs])
+        for t in r.tasks:
+            # Tasks of host contexts an optimizer dropped are never written out.
+            if id(t.host_context) not in live:
+                continue
+            task = t.get_yaml()
+            task["name"] = str(t)
+            records.append(["t", index[r], hctx_ids[id(t.host_context)], enc(task)])
+            tasks += 1
+    edges = [["e", index[u], index[v]] for u in dag.graph for v in dag.graph[u]]
+
+    header = {
+        "format": PLAN_FORMAT,
+        "version": PLAN_VERSION,
+        "host_contexts": len(hctx_records),
+        "runnables": len(index),
+        "tasks": tasks,
+        "edges": len(edges),
+    }
+    dumps = json.JSONEncoder(separators=(",", ":")).encode
+    f.write(dumps(header) + "\n")
+    f.write(dumps({"strings": enc.strings}) + "\n")
+    for record in hctx_records + records + edges:
+        f.write(dumps(record) + "\n")
+    return header
+
+
+class PlannedTask():
+    """
+    A task read from a plan, with the interface HostContext needs to render it.
+    """
+    __slots__ = ("host_context", "yaml")
+
+    def __init__(self, host_context, yaml):
+        self.host_context = host_context
+        self.yaml = yaml
+
+    def get_yaml(self):
+        out = dict(self.yaml)
+        del out["name"]
+        return out
+
+    def __str__(self):
+        return self.yaml["name"]
+
+
+class PlannedRunnable():
+    """
+    A Runnable read from a plan. It has no method, only what the build
+    decided for it.
+    """
+    def __init__(self, name, task_settings, hctx_settings, host_contexts):
+        self.name = name
+        self.task_settings = task_settings
+        self.hctx_settings = hctx_settings
+        self.host_contexts = host_contexts
+        self.tasks = []
+
+    def __repr__(self):
+        return f"<PlannedRunnable '{self.name}'>"
+
+
+def load_plan(path):
+    """
+    Read the plan at path into a RunnableDAG of PlannedRunnables. Their host
+    contexts are plain HostContexts, so hctx.get_yaml(r) renders the same
+    plays the build would have.
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get("format") != PLAN_FORMAT:
+            raise ValueError(f"{path} is not a decibel plan")
+        if header.get("version") != PLAN_VERSION:
+            raise ValueError(f"{path} is plan version {header.get('version')}, expected {PLAN_VERSION}")
+        decode = _decoder(json.loads(f.readline())["strings"])
+
+        dag = RunnableDAG()
+        hctxs = []
+        runnables = []
+        for line in f:
+            record = json.loads(line)
+            kind = record[0]
+            if kind == "t":
+                r = runnables[record[1]]
+                r.tasks.append(PlannedTask(hctxs[record[2]], decode(record[3])))
+            elif kind == "e":
+                dag.add_edge(runnables[record[1]], runnables[record[2]])
+            elif kind == "r":
+                r = PlannedRunnable(
+                    decode(record[1]), decode(record[2]), decode(record[3]),
+                    [hctxs[i] for i in record[4]],
+                )
+                runnables.append(r)
+                dag.add_node(r)
+            elif kind == "h":
+                hctx = HostContext(None, decode(record[1]), **decode(record[2]))
+                hctx.vars = decode(record[3])
+                hctxs.append(hctx)
+            else:
+                raise ValueError(f"Unknown record {kind!r} in {path}")
+    return dag
@@ -0,0 +1,112 @@
+"""
+Passes over the list of play dicts produced by Decibel.run.
+"""
+
+
+def _play_header(play):
+    return {key: val for key, val in play.items() if key not in ("name", "tasks", "vars")}
+
+
+def _merge_group(group):
+    if len(group) == 1:
+        return group[0]
+    out = dict(group[0])
+    out["name"] = f"{group[0]['name']} and {len(group) - 1} more"
+    if all(play.get("vars") == group[0].get("vars") for play in group):
+        out["tasks"] = [t for play in group for t in play["tasks"]]
+        return out
+    # Plays with different vars keep them on a block of their own, which
+    # Ansible scopes the same way as play vars.
+    out.pop("vars", None)
+    out["tasks"] = []
+    for play in group:
+        if play.get("vars"):
+            out["tasks"].append({
+                "name": play["name"],
+                "block": play["tasks"],
+                "vars": play["vars"],
+            })
+        else:
+            out["tasks"].extend(play["tasks"])
+    return out
+
+
+def merge_plays(plays, stats=None):
+    """
+    Merge adjacent plays that run against the same hosts with the same settings.
+    Tags and conditions live on the tasks and are kept as they are.
+
+    Merged plays are yielded as soon as their group ends. If stats is given,
+    it is filled with the play count before and after merging.
+    """
+    before = after = 0
+    group = []
+    for play in plays:
+        before += 1
+        if group and _play_header(group[0]) != _play_header(play):
+            after += 1
+            yield _merge_group(group)
+            group = []
+        group.append(play)
+    if group:
+        after += 1
+        yield _merge_group(group)
+    if stats is not None:
+        stats["before"] = before
+        stats["after"] = after
+
+
+def _first_condition(task):
+    # Conditions from predicate scopes are lists, outermost scope first.
+    when = task.get("when")
+    if "block" in task or not isinstance(when, list) or not when:
+        return None
+    return when[0]
+
+
+def _hoist(tasks, stats):
+    out = []
+    i = 0
+    while i < len(tasks):
+        task = tasks[i]
+        if "block" in task:
+            out.append(dict(task, block=_hoist(task["block"], stats)))
+            i += 1
+            continue
+        condition = _first_condition(task)
+        j = i + 1
+        while condition is not None and j < len(tasks) and _first_condition(tasks[j]) == condition:
+            j += 1
+        if j - i == 1:
+            out.append(task)
+            i += 1
+            continue
+        inner = []
+        for t in tasks[i:j]:
+            t = dict(t, when=t["when"][1:])
+            if not t["when"]:
+                del t["when"]
+            inner.append(t)
+        stats["blocks"] += 1
+        stats["tasks"] += j - i
+        # Nested scopes become nested blocks.
+        out.append({"block": _hoist(inner, stats), "when": condition})
+        i = j
+    return out
+
+
+def hoist_conditions(plays, stats=None):
+    """
+    Move the condition of a predicate scope that consecutive tasks share onto
+    a block around them, so it is written out once rather than on each task.
+    Ansible evaluates a task the same way whether its condition is its own
+    or inherited from a block.
+
+    If stats is given, it is filled with the number of blocks created and the
+    tasks moved into them.
+    """
+    if stats is None:
+        stats = {}
+    stats.update(blocks=0, tasks=0)
+    for play in plays:
+        yield dict(play, tasks=_hoist(play["tasks"], stats))
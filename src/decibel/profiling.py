@@ -0,0 +1,144 @@
+"""
+Build instrumentation, used by decibel build --profile.
+
+Code under measurement wraps its phases in span(name) and reports sizes
+with count(name). Both do nothing unless a Profiler is active in the
+current context, so they can stay in the build path for good.
+
+Allocations are the change in sys.getallocatedblocks() over a span, that
+is the net number of memory blocks the phase left allocated.
+"""
+import os
+import sys
+import time
+from _thread import get_ident
+from contextvars import ContextVar
+
+_current_profiler = ContextVar("decibel_current_profiler", default=None)
+
+
+class _NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span():
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        # How many spans of the same name this one runs inside, such as a
+        # Runbook set up from a Runnable of another Runbook.
+        active = self.profiler._active
+        self.depth = active.get(self.name, 0)
+        active[self.name] = self.depth + 1
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, type, value, tb):
+        end = time.perf_counter_ns()
+        self.profiler._record(self, end, sys.getallocatedblocks() - self.blocks)
+        self.profiler._active[self.name] = self.depth
+
+
+class Profiler():
+    def __init__(self, name=None):
+        self.name = name
+        self.spans = []
+        self.counters = {}
+        self._active = {}
+        self._start = time.perf_counter_ns()
+        self._end = None
+        self._context_token = None
+
+    def __enter__(self):
+        self._context_token = _current_profiler.set(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        self._end = time.perf_counter_ns()
+        _current_profiler.reset(self._context_token)
+
+    def span(self, name, **args):
+        return _Span(self, name, args)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _record(self, span, end, blocks):
+        self.spans.append((span.name, span.args, span.start, end, blocks, get_ident(), span.depth))
+
+    def report(self):
+        """
+        Time and allocations per phase, summed over every span with the same
+        name, in the order the phases first ran. A span inside another span
+        of the same name counts as a call, but its time and allocations are
+        already part of the outer one.
+        """
+        phases = {}
+        for name, _, start, end, blocks, _, depth in sorted(self.spans, key=lambda span: span[2]):
+            phase = phases.setdefault(name, {"calls": 0, "seconds": 0.0, "allocated_blocks": 0})
+            phase["calls"] += 1
+            if depth == 0:
+                phase["seconds"] += (end - start) / 1e9
+                phase["allocated_blocks"] += blocks
+        end = self._end if self._end is not None else time.perf_counter_ns()
+        return {
+            "name": self.name,
+            "total_seconds": (end - self._start) / 1e9,
+            "phases": phases,
+            "counters": dict(self.counters),
+        }
+
+    def trace(self):
+        """
+        The spans in Chrome's trace event format, for chrome://tracing or Perfetto.
+        """
+        pid = os.getpid()
+        events = []
+        for name, args, start, end, blocks, tid, _ in self.spans:
+            events.append({
+                "name": name,
+                "cat": "decibel",
+                "ph": "X",
+                "ts": (start - self._start) / 1e3,
+                "dur": (end - start) / 1e3,
+                "pid": pid,
+                "tid": tid,
+                "args": dict(args, allocated_blocks=blocks),
+            })
+        events.sort(key=lambda event: event["ts"])
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_report(self, path):
+        import json
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_trace(self, path):
+        import json
+        with open(path, "w") as f:
+            json.dump(self.trace(), f)
+
+
+def enabled():
+    return _current_profiler.get() is not None
+
+def span(name, **args):
+    profiler = _current_profiler.get()
+    if profiler is None:
+        return _NO_SPAN
+    return profiler.span(name, **args)
+
+def count(name, n=1):
+    profiler = _current_profiler.get()
+    if profiler is not None:
+        profiler.count(name, n)
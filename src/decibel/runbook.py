@@ -1,6 +1,6 @@
-import inspect
+from types import FunctionType
 
-from . import context
+from . import context, profiling
 from .runnable import Runnable
 from .dsl import Variable
 
@@ -12,6 +12,17 @@ class RunbookVars():
     def __getattr__(self, name):
         return self._vars.get(name, None)
 
+def _members(cls, kind):
+    """
+    Like inspect.getmembers(cls), limited to instances of kind.
+    """
+    members = []
+    for name in sorted(dir(cls)):
+        value = getattr(cls, name)
+        if isinstance(value, kind):
+            members.append((name, value))
+    return members
+
 class Runbook():
     def __init_subclass__(cls, **kwargs):
         super().__init_subclass__(**kwargs)
@@ -19,7 +30,7 @@ class Runbook():
         # and patch any run_-prefixed functions as Runnables.
         # Any function with a flow decorator (@after etc) will
         # already be registered as a Runnable.
-        members = inspect.getmembers(cls, predicate=inspect.isfunction)
+        members = _members(cls, FunctionType)
         for member in members:
             if not member[0].startswith("run_"):
                 continue
@@ -27,7 +38,9 @@ class Runbook():
                 continue
             r = Runnable(member[1])
             setattr(cls, member[0], r)
-
+        # Resolve the Runnable table once per class, instances only look it up.
+        cls._runnables = _members(cls, Runnable)
+        cls._runnable_index = dict(cls._runnables)
 
     def __init__(self, **kwargs):
         self._host_context = context.get_current_host_context().copy()
@@ -44,46 +57,37 @@ class Runbook():
         # Runbook sometime after Runnable.
         if context.get_current_runnable() is not None:
             self.run_after.add(context.get_current_runnable())
-        with self:
+        with self, profiling.span("Runbook._setup", runbook=type(self).__name__):
             self._setup()
     
     def setup(self):
         pass
 
     def __enter__(self):
-        self._old_current = context.get_current_runbook()
-        context.set_current_runbook(self)
+        self._context_token = context.set_current_runbook(self)
 
     def __exit__(self, type, value, tb):
-       context.set_current_runbook(self._old_current)
-
-    def _is_runnable(self, obj):
-        return isinstance(obj, Runnable)
+       context.reset_current_runbook(self._context_token)
 
     def _setup(self):
         with self._host_context:
             self.setup()
 
-            members = inspect.getmembers(self.__class__, predicate=self._is_runnable)
+            index = self._runnable_index
             # Iterate over all bound Runnables inside class and resolve soft-linked
             # dependencies. These exist because you cannot reference class.function
             # when the class is being read.
             # When all dependencies are resolved, instanciate the bound variant of the Runnable
             # to collect all Tasks and child Runnables.
-            for _, r in members:
-                run_before = set()
+            for _, r in self._runnables:
+                state = r.state
                 for f in r.run_before:
-                    if not isinstance(f, str):
-                        run_before.add(f)
-                        continue
-                    run_before.add([m[1] for m in members if m[0] == f][0])
-                r.run_before = run_before | self.run_before
-                
-                run_after = set()
+                    if isinstance(f, str):
+                        state.run_before.add(index[f])
+                state.run_before |= self.run_before
+
                 for f in r.run_after:
-                    if not isinstance(f, str):
-                        run_after.add(f)
-                        continue
-                    run_after.add([m[1] for m in members if m[0] == f][0])
-                r.run_after = run_after | self.run_after
+                    if isinstance(f, str):
+                        state.run_after.add(index[f])
+                state.run_after |= self.run_after
                 r(self)
\ No newline at end of file
@@ -1,36 +1,62 @@
-import inspect
 import os.path
 
 from . import context
 
+class RunnableState():
+    """
+    What a Runnable collects during one build. Runnables are shared by every
+    Decibel instance that uses their Runbook, so this lives on the instance.
+    """
+    def __init__(self, runnable):
+        self.tasks = []
+        self.host_contexts = []
+        self.run_before = {r for r in runnable.run_before if not isinstance(r, str)}
+        self.run_after = {r for r in runnable.run_after if not isinstance(r, str)}
+
 class Runnable():
     def __init__(self, method):
         self.method = method
-        self.tasks = []
-        self.host_contexts = []
         self.hctx_settings = {}
         self.task_settings = {}
+        # Declared dependencies, may contain names of Runnables in the same Runbook.
         self.run_before = set()
         self.run_after = set()
 
-        self.runnable_path = os.path.dirname(inspect.getfile(method))
+        code = getattr(method, "__code__", None)
+        if code is None:
+            import inspect
+            self.runnable_path = os.path.dirname(inspect.getfile(method))
+        else:
+            self.runnable_path = os.path.dirname(code.co_filename)
 
     def __repr__(self):
         return f"<Runnable '{self.name}'>"
 
-    def __enter__(self):
-        self._old_current = context.get_current_runnable()
-        context.set_current_runnable(self)
+    @property
+    def state(self):
+        return context.get_current_instance().get_runnable_state(self)
+
+    @property
+    def tasks(self):
+        return self.state.tasks
+
+    @property
+    def host_contexts(self):
+        return self.state.host_contexts
 
-    def __exit__(self, type, value, tb):
-        context.set_current_runnable(self._old_current)
+    @host_contexts.setter
+    def host_contexts(self, value):
+        self.state.host_contexts = value
 
     def __call__(self, *args, **kwargs):
         hctx = context.get_current_host_context()
-        self.host_contexts.append(hctx)
-        hctx.runnables.add(self)
-        with self:
+        self.state.host_contexts.append(hctx)
+        hctx.runnables[self] = None
+        token = context.set_current_runnable(self)
+        try:
             self.method(*args, **kwargs)
+        finally:
+            context.reset_current_runnable(token)
         
         if len(context.get_current_predicates()):
             raise AttributeError("Not all predicates were deregistered")
@@ -43,4 +69,4 @@ class Runnable():
         return self.method == other.method
 
     def __hash__(self):
-        return hash(self.method)
\ No newline at end of file
+        return hash(self.method)
@@ -1,5 +1,6 @@
 import decibel.context as context
-from decibel.ansible.tasks import get_url, copy
+from decibel.ansible.tasks import get_url, copy, file, synchronize
+import hashlib
 import os.path
 
 def get_file(src, **kwargs):
@@ -20,17 +21,62 @@ def _get_relative_dir():
     return path.replace("\\", "/")
 
 def _get_file_bundle(src, **kwargs):
-    base_path = _get_relative_dir()
+    path = os.path.join(context.get_current_runnable().runnable_path, src)
+    bundled = context.get_current_instance().bundle.add(path)
+    kwargs.setdefault("checksum", bundled.checksum)
     return copy(
-        src=f"bundle-out/{base_path}/{src}",
+        src=bundled.src,
         **kwargs
     )
 
 def _get_file_fetch(src, **kwargs):
+    """
+    Download the file once per play, on the controller or on fetch_cache_host,
+    and hand it out from there over the local network. The controller copies
+    it to every host, a cache host pushes it with rsync to a staging path that
+    is then copied into place. Hosts that already have the file are skipped.
+    """
+    instance = context.get_current_instance()
     base_path = _get_relative_dir()
-    base_url = context.get_current_instance().settings["fetch_base_url"]
-    return get_url(
-        url=f"{base_url}/{base_path}/{src}",
+    url = f"{instance.settings['fetch_base_url']}/{base_path}/{src}"
+    cache_host = instance.settings["fetch_cache_host"]
+    cache_dir = instance.settings["fetch_cache_dir"]
+    if cache_dir is None:
+        cache_dir = "/var/cache/decibel-fetch" if cache_host else "{{ playbook_dir }}/.decibel-fetch"
+    url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+    cache_path = f"{cache_dir}/{url_hash}-{os.path.basename(src)}"
+
+    # The file is usually in the repository as well, the checksums from it let
+    # Ansible verify every transfer and skip the ones that are not needed.
+    sha256 = sha1 = None
+    local_path = os.path.join(context.get_current_runnable().runnable_path, src)
+    if os.path.isfile(local_path):
+        sha256, sha1 = instance.bundle.checksums(local_path)
+    download = {"checksum": f"sha256:{sha256}"} if sha256 else {}
+    if sha1:
+        kwargs.setdefault("checksum", sha1)
+
+    delegated = {"become": False} if cache_host is None else {}
+    file(path=cache_dir, state="directory").run_once().on(cache_host or "localhost").with_settings(**delegated)
+    get_url(
+        url=url,
+        dest=cache_path,
+        **download
+    ).run_once().on(cache_host or "localhost").with_settings(**delegated)
+    if cache_host is None:
+        return copy(
+            src=cache_path,
+            **kwargs
+        )
+    file(path=cache_dir, state="directory")
+    synchronize(
+        src=cache_path,
+        dest=cache_path,
+        checksum=True
+    ).on(cache_host)
+    return copy(
+        src=cache_path,
+        remote_src=True,
         **kwargs
     )
 
@@ -0,0 +1,85 @@
+"""
+Historical task timings, used to weigh Runnables by how long they take.
+
+A timing file is either the output of Ansible's json stdout callback
+(ANSIBLE_STDOUT_CALLBACK=json), or a plain mapping of
+{runnable name: {task name: seconds}}. Decibel names plays after their
+Runnable and tasks after their Task, so both formats key on the same names.
+Plays of the waves schedule or of merge_runnables are named after several
+Runnables, so their tasks are matched on the task name alone.
+"""
+import json
+from datetime import datetime
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _callback_durations(data):
+    for play in data.get("plays", []):
+        play_name = play.get("play", {}).get("name")
+        for task in play.get("tasks", []):
+            info = task.get("task", {})
+            duration = info.get("duration", {})
+            if "start" not in duration or "end" not in duration:
+                continue
+            seconds = (_parse_time(duration["end"]) - _parse_time(duration["start"])).total_seconds()
+            yield play_name, info.get("name"), seconds
+
+
+def load_timings(path):
+    """
+    Load a timing file into {(runnable name, task name): seconds}, averaging
+    tasks that ran more than once. Every task name is also stored under
+    (None, task name), averaged over all the plays it ran in.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if "plays" in data:
+        durations = _callback_durations(data)
+    else:
+        durations = (
+            (runnable, task, seconds)
+            for runnable, tasks in data.items()
+            for task, seconds in tasks.items()
+        )
+    totals = {}
+    for runnable, task, seconds in durations:
+        for key in {(runnable, task), (None, task)}:
+            total, count = totals.get(key, (0.0, 0))
+            totals[key] = (total + seconds, count + 1)
+    return {key: total / count for key, (total, count) in totals.items()}
+
+
+def runnable_costs(graph, timings):
+    """
+    Estimated seconds every Runnable in graph takes, over all its host contexts.
+    Tasks are looked up by Runnable and task name, then by task name alone.
+    Tasks without history are assumed to take the average time of a known task.
+    """
+    known = [seconds for (runnable, _), seconds in timings.items() if runnable is None]
+    default = sum(known) / len(known) if known else 1.0
+    costs = {}
+    tasks = matched = 0
+    for r in graph.graph:
+        cost = 0.0
+        # Tasks of host contexts an optimizer dropped are never run.
+        live = {id(hctx) for hctx in r.host_contexts}
+        for t in r.tasks:
+            if id(t.host_context) not in live:
+                continue
+            name = str(t)
+            seconds = timings.get((r.name, name))
+            if seconds is None:
+                seconds = timings.get((None, name))
+            if seconds is None:
+                seconds = default
+            else:
+                matched += 1
+            cost += seconds
+            tasks += 1
+        costs[r] = cost
+    if tasks and not matched:
+        print(f"Warning: none of the {tasks} tasks has a timing in the history, every Runnable gets the default cost")
+    return costs
@@ -23,12 +23,20 @@ class ConsulAgent(Runbook):
             ).changed():
                 command("consul --datacenter={{datacenter}}")
 
+        # A task result is only known on the host, so this stays a when.
+        leader = command("consul info -leader-datacenter")
+        command("consul operator raft transfer-leader").when(self.vars.datacenter != leader.stdout)
+
 class VaultAgent(Runbook):
     def run_do(self):
         apt(
             name="vault",
             state="installed"
         )
+        # Both are Runbook vars, so this is decided when the config is built.
+        command("vault operator raft autopilot set-config -cleanup-dead-servers=true").when(
+            self.vars.datacenter == self.vars.primary_datacenter
+        )
 
 class ConsulTemplate(Runbook):
     def run_do(self):
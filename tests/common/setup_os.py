@@ -75,7 +75,8 @@ class SetupOS(Runbook):
             datacenter=self.vars.datacenter
         )
         VaultAgent(
-            datacenter=self.vars.datacenter
+            datacenter=self.vars.datacenter,
+            primary_datacenter="dc3"
         )
         ConsulTemplate(
             datacenter=self.vars.datacenter